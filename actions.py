@@ -14,11 +14,19 @@ import almath
 import cv2
 
 import angle_interpolation as ai
+import vision_definitions as vd
 
+from naoqi import ALProxy
+from frame_bus import FrameBus
+from pose_snapshot import PoseSnapshot
+from pose_history import PoseHistory
+from ball_tracker import BallTracker
 from motion_basis import MotionBasis
 from golf_ball_detect import GolfBallDetect
 from stick_detect import StickDetect
 from landmark_detect import LandMarkDetect
+from landmark_service import LandmarkService
+from landmark_tracker import LandmarkTracker
 
 
 class Actions(MotionBasis):
@@ -40,9 +48,109 @@ class Actions(MotionBasis):
         super(Actions, self).__init__(ip, port)
         self.max_speed_fraction = 0.05
 
-        self.ball_detector = GolfBallDetect(ip, port)
-        self.stick_detector = StickDetect(ip, port)
+        # While approaching, the ball stays close to where it was seen, so only that region is searched.
+        self.ball_detector = GolfBallDetect(ip, port, is_tracking=True)
+        # Keeps the ball through walks and missed frames, so a dropped frame does not start a new head search.
+        self.ball_tracker = BallTracker(self.ball_detector)
+        self.stick_detector = StickDetect(ip, port, is_tracking=True)
         self.landmark_detector = LandMarkDetect(ip, port)
+        # Keeps the hole in the odometry frame, so most shots get its bearing without a head sweep.
+        self.landmark_tracker = LandmarkTracker(self.landmark_detector)
+
+        # All the detectors read their frames from one bus, so each camera is transferred once per tick.
+        self.frame_bus = FrameBus(ip, port)
+        self.frame_bus.register(self.ball_detector)
+        self.frame_bus.register(self.stick_detector)
+        self.frame_bus.register(self.landmark_detector)
+
+        # The detectors of one tick share one read of the head pose instead of asking ALMotion each.
+        self.pose_snapshot = PoseSnapshot(self.motionProxy, self.memoryProxy)
+        self.ball_detector.attach_pose_snapshot(self.pose_snapshot)
+        self.stick_detector.attach_pose_snapshot(self.pose_snapshot)
+        self.landmark_detector.attach_pose_snapshot(self.pose_snapshot)
+        self.pose_history = None
+        self.landmark_service = None
+
+    def perceive(self, client='xxx', stand_state="standInit"):
+        """
+        Run a full perception pass, ball and stick detectors share the frames captured in this tick.
+
+        :arg:
+            :param client: client name
+            :type client: str
+            :param stand_state: Stand state of NAO robot, "standInit" or "standUp"
+            :type stand_state: str
+        :return: None
+        """
+        # Top and bottom frames come from one synchronized transfer, no camera switching is needed.
+        self.frame_bus.capture_pair(client)
+        self.pose_snapshot.update(force=True)
+        self.ball_detector.update_ball_data(client=client, stand_state=stand_state)
+        self.stick_detector.update_stick_data(client=client)
+
+    def start_pose_history(self):
+        """
+        Start sampling the head joints in the background, so that frames captured while the head moves
+        are localised with the head pose at their capture time.
+
+        :return: None
+        """
+        if self.pose_history is not None and self.pose_history.is_running:
+            return
+        # The sampler thread gets its own proxy so that it never shares a connection with the main thread.
+        self.pose_history = PoseHistory(ALProxy("ALMemory", self.ip, self.port))
+        self.pose_history.start()
+        self.pose_snapshot.attach_history(self.pose_history)
+
+    def stop_pose_history(self):
+        """
+        Stop the background head joint sampler.
+
+        :return: None
+        """
+        self.pose_snapshot.attach_history(None)
+        if self.pose_history is not None:
+            self.pose_history.stop()
+            self.pose_history = None
+
+    def start_landmark_service(self, period=100):
+        """
+        Keep the landmark detection subscribed, so that a landmark search is one continuous head sweep
+        stopped by the first mark event.
+
+        :arg:
+            :param period: period of ALLandMarkDetection in ms
+            :type period: int
+        :return: None
+        """
+        if self.landmark_service is not None:
+            return
+        self.landmark_service = LandmarkService(self.ip, self.port, period=period)
+        self.landmark_service.start()
+        self.landmark_detector.attach_landmark_service(self.landmark_service)
+
+    def stop_landmark_service(self):
+        """
+        Unsubscribe the landmark detection, the search polls ALMemory again.
+
+        :return: None
+        """
+        self.landmark_detector.attach_landmark_service(None)
+        if self.landmark_service is not None:
+            self.landmark_service.close()
+            self.landmark_service = None
+
+    def wait_head_settled(self, seconds):
+        """
+        Wait for the head to settle before capturing, not needed while the head joints are sampled.
+
+        :arg:
+            :param seconds: how long to wait without a joint history
+            :type seconds: float
+        :return: None
+        """
+        if self.pose_history is None or not self.pose_history.is_running:
+            time.sleep(seconds)
 
     def move_head_searching(self, find_ball=True, client='xxx'):
         """
@@ -56,12 +164,16 @@ class Actions(MotionBasis):
             :type client: str
         :return: None
         """
+        if not self.frame_bus.is_streaming:
+            self.frame_bus.start_streaming(client, [vd.kBottomCamera])
+        self.start_pose_history()
+
         for i in range(1):
             names = ['HeadPitch', 'HeadYaw']
             targe_tangles = [40 * almath.TO_RAD, 1.0 * almath.TO_RAD]
             self.motionProxy.angleInterpolationWithSpeed(names, targe_tangles, self.max_speed_fraction)
-            time.sleep(1)
-            self.ball_detector.update_ball_data(client=client)
+            self.wait_head_settled(1)
+            self.ball_tracker.update(client=client)
             self.ball_detector.show_ball_position()
             cv2.waitKey(1000)
             [x, y, angle] = self.ball_detector.ball_position
@@ -71,8 +183,8 @@ class Actions(MotionBasis):
             names = ['HeadPitch', 'HeadYaw']
             targe_tangles = [-10 * almath.TO_RAD, 1.0 * almath.TO_RAD]
             self.motionProxy.angleInterpolationWithSpeed(names, targe_tangles, self.max_speed_fraction)
-            time.sleep(2)
-            self.ball_detector.update_ball_data(client=client)
+            self.wait_head_settled(2)
+            self.ball_tracker.update(client=client)
             self.ball_detector.show_ball_position()
             cv2.waitKey(1000)
             [x, y, angle] = self.ball_detector.ball_position
@@ -82,8 +194,8 @@ class Actions(MotionBasis):
             name = ["HeadYaw"]
             target_angle = 40.3 * almath.TO_RAD
             self.motionProxy.angleInterpolationWithSpeed(name, target_angle, self.max_speed_fraction)
-            time.sleep(1)
-            self.ball_detector.update_ball_data(client=client)
+            self.wait_head_settled(1)
+            self.ball_tracker.update(client=client)
             self.ball_detector.show_ball_position()
             cv2.waitKey(1000)
             [x, y, angle] = self.ball_detector.ball_position
@@ -92,15 +204,15 @@ class Actions(MotionBasis):
 
             target_angle = 1.0 * almath.TO_RAD
             self.motionProxy.angleInterpolationWithSpeed(name, target_angle, self.max_speed_fraction)
-            time.sleep(1.0)
+            self.wait_head_settled(1.0)
             fraction = -45.2
             if find_ball:
                 fraction = -51.2
             target_angle = fraction * almath.TO_RAD
             self.motionProxy.angleInterpolationWithSpeed(name, target_angle, self.max_speed_fraction)
-            time.sleep(1.0)
+            self.wait_head_settled(1.0)
 
-            self.ball_detector.update_ball_data(client=client)
+            self.ball_tracker.update(client=client)
             self.ball_detector.show_ball_position()
             cv2.waitKey(1000)
             [x, y, angle] = self.ball_detector.ball_data
@@ -136,15 +248,18 @@ class Actions(MotionBasis):
         # Start searching the ball
         self.move_head_searching(client=client)
 
-        [x, y, angle] = self.ball_detector.ball_position
+        [x, y, angle] = self.ball_tracker.position
         print "Ball position: x = {}, y = {}, angle = {}".format(x, y, angle)
         self.look_down()
 
         while x > MAX_X or y > MAX_Y or y < -MAX_Y or \
                 angle > MAX_ANGLE or angle < -MAX_ANGLE:
             move_to_ball(x, y, angle)
-            self.move_head_searching(client=client)
-            [x, y, angle] = self.ball_detector.ball_position
+            # The track follows the walk with odometry, search again only once it has been lost.
+            self.ball_tracker.update(client=client)
+            if not self.ball_tracker.is_tracking:
+                self.move_head_searching(client=client)
+            [x, y, angle] = self.ball_tracker.position
 
             print "Ball position: x = {}, y = {}, angle = {}".format(x, y, angle)
             self.look_down()
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2023/12/11 21:37
+@Author  : Evan Wong
+@File    : ball_benchmark.py
+@Project : NAOGolf
+@Description: Compare latency and hit rate of the ball detection engines on the frames of a frame log
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+from frame_log import FrameReplay
+from golf_ball_detect import GolfBallDetect, BALL_ENGINES
+
+
+def run_engine(log_path, engine, stand_state="standInit"):
+    """
+    Run ball detection with one engine over every bottom camera frame of a frame log.
+
+    :arg:
+        :param log_path: path of the frame log
+        :type log_path: str
+        :param engine: circle detection engine of GolfBallDetect
+        :type engine: str
+        :param stand_state: Stand state of NAO robot, "standInit" or "standUp"
+        :type stand_state: str
+    :return:
+        (latencies in seconds, ball data of each frame)
+        :rtype: tuple
+    """
+    replay = FrameReplay(log_path)
+    detector = GolfBallDetect(None, engine=engine)
+    replay.attach(detector)
+    latencies = []
+    results = []
+    stdout = sys.stdout
+    # The detectors print a lot on every frame, keep the report readable.
+    sys.stdout = open(os.devnull, "w")
+    try:
+        while True:
+            last_frame_id = detector.frameID
+            start = time.time()
+            detector.update_ball_data(stand_state=stand_state)
+            end = time.time()
+            if detector.frameID == last_frame_id:
+                break
+            latencies.append(end - start)
+            results.append(detector.ball_data)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        replay.close()
+    return np.array(latencies), results
+
+
+def is_same_ball(ball, reference):
+    """
+    Whether two detections are the same ball, centers closer than half of the radius.
+
+    :arg:
+        :param ball: [centerX, centerY, radius]
+        :type ball: list
+        :param reference: [centerX, centerY, radius]
+        :type reference: list
+    :return:
+        True means the same ball
+        :rtype: bool
+    """
+    if ball[2] == 0 or reference[2] == 0:
+        return ball[2] == reference[2]
+    distance = np.hypot(float(ball[0]) - float(reference[0]), float(ball[1]) - float(reference[1]))
+    return distance <= max(1.0, reference[2] / 2.0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the ball detection engines on a frame log.")
+    parser.add_argument("log_path", help="frame log recorded with VisualBasis.start_recording()")
+    parser.add_argument("--stand-state", default="standInit", choices=["standInit", "standUp"])
+    args = parser.parse_args()
+
+    reports = dict((engine, run_engine(args.log_path, engine, args.stand_state)) for engine in BALL_ENGINES)
+    reference = reports["hough"][1]
+    print "%-12s %8s %10s %10s %10s %12s" % ("engine", "frames", "mean ms", "p95 ms", "hit rate", "agree hough")
+    for engine in BALL_ENGINES:
+        latencies, results = reports[engine]
+        if len(results) == 0:
+            print "No bottom camera frame in " + args.log_path
+            break
+        hits = np.mean([ball[2] != 0 for ball in results])
+        agree = np.mean([is_same_ball(ball, ref) for ball, ref in zip(results, reference)])
+        print "%-12s %8d %10.2f %10.2f %10.3f %12.3f" % (engine, len(results), latencies.mean() * 1000,
+                                                       np.percentile(latencies, 95) * 1000, hits, agree)
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2023/12/15 15:12
+@Author  : Evan Wong
+@File    : ball_tracker.py
+@Project : NAOGolf
+@Description: Kalman filter over the ball detections, keeping the ball through walks and missed frames
+"""
+
+import time
+
+import numpy as np
+
+# 99% gate of a 2D measurement (chi-square, 2 degrees of freedom)
+GATE_THRESHOLD = 9.21
+
+
+class BallTracker(object):
+    """
+    Kalman filter of the ball in the odometry frame, with a damped velocity.
+
+    Detections are moved from the robot frame into the odometry frame with ALMotion.getRobotPosition(),
+    so the track stays valid while the robot walks. The ball mostly lies still, so its velocity decays towards
+    zero and stays bounded, and a long wait does not blow the position up. The uncertainty grows with the
+    distance walked and the angle turned, since the odometry drifts with them. A missed frame only predicts,
+    the track is kept for max_coast misses in a row as long as its position uncertainty stays below max_sigma.
+    """
+
+    def __init__(self, ball_detector, motion_proxy=None, velocity_sigma=0.1, velocity_time=0.5, max_speed=1.0,
+                 measure_sigma=0.02, measure_sigma_per_meter=0.05, odometry_sigma_per_meter=0.1,
+                 odometry_sigma_per_rad=0.1, max_coast=5, max_sigma=0.15):
+        """
+        Initialization.
+
+        :arg:
+            :param ball_detector: the detector providing the measurements
+            :type ball_detector: GolfBallDetect
+            :param motion_proxy: ALMotion proxy for the odometry, None to use the one of the detector
+            :type motion_proxy: ALProxy
+            :param velocity_sigma: standard deviation of the ball velocity in m/s, once nothing is known of it
+            :type velocity_sigma: float
+            :param velocity_time: time constant in seconds of the velocity decaying towards zero
+            :type velocity_time: float
+            :param max_speed: largest ball speed in m/s, the filtered velocity is clamped to it
+            :type max_speed: float
+            :param measure_sigma: standard deviation of a detection right in front of the robot in meter
+            :type measure_sigma: float
+            :param measure_sigma_per_meter: growth of the detection standard deviation with the distance
+            :type measure_sigma_per_meter: float
+            :param odometry_sigma_per_meter: odometry drift in meter per meter walked
+            :type odometry_sigma_per_meter: float
+            :param odometry_sigma_per_rad: odometry drift in rad per rad turned
+            :type odometry_sigma_per_rad: float
+            :param max_coast: how many missed frames in a row the track survives
+            :type max_coast: int
+            :param max_sigma: largest position standard deviation of a usable track in meter
+            :type max_sigma: float
+        :return: None
+        """
+        self.ballDetector = ball_detector
+        self.motionProxy = motion_proxy
+        self.velocitySigma = velocity_sigma
+        self.velocityTime = velocity_time
+        self.maxSpeed = max_speed
+        self.measureSigma = measure_sigma
+        self.measureSigmaPerMeter = measure_sigma_per_meter
+        self.odometrySigmaPerMeter = odometry_sigma_per_meter
+        self.odometrySigmaPerRad = odometry_sigma_per_rad
+        self.maxCoast = max_coast
+        self.maxSigma = max_sigma
+        self.state = None  # [x, y, vx, vy] in the odometry frame
+        self.covariance = None
+        self.timestamp = 0.0
+        self.missCount = 0
+        self.isDetected = False
+        self._odometry = (0.0, 0.0, 0.0)
+
+    def reset(self):
+        """
+        Drop the track.
+
+        :return: None
+        """
+        self.state = None
+        self.covariance = None
+        self.missCount = 0
+        self.isDetected = False
+
+    def update(self, client="python-client", stand_state="standInit", **kwargs):
+        """
+        Detect the ball in a new frame and filter the detection into the track.
+
+        :arg:
+            :param client: client name
+            :type client: str
+            :param stand_state: Stand state of NAO robot, "standInit" or "standUp"
+            :type stand_state: str
+            :param kwargs: other arguments of GolfBallDetect.update_ball_data()
+            :type kwargs: dict
+        :return: None
+        """
+        self.ballDetector.update_ball_data(client=client, stand_state=stand_state, **kwargs)
+        motion_proxy = self.motionProxy or self.ballDetector.motionProxy
+        self.predict(time.time(), tuple(motion_proxy.getRobotPosition(False)))
+
+        self.isDetected = self.ballDetector.is_golf_ball_insight()
+        if not self.isDetected:
+            self.missCount += 1
+            if not self.is_tracking:
+                self.reset()
+            return
+
+        candidates = self.ballDetector.ball_candidates
+        measurements = zip(candidates["disX"], candidates["disY"])
+        if self.state is None:
+            self.__start(*self.__measurement(*measurements[0]))
+            return
+
+        # The best ranked candidate consistent with the track is used, the next ones cover a rejected first one.
+        for dis_x, dis_y in measurements:
+            measurement, noise = self.__measurement(dis_x, dis_y)
+            innovation = measurement - self.state[:2]
+            innovation_cov = self.covariance[:2, :2] + noise
+            if innovation.dot(np.linalg.solve(innovation_cov, innovation)) <= GATE_THRESHOLD:
+                gain = self.covariance[:, :2].dot(np.linalg.inv(innovation_cov))
+                self.state = self.state + gain.dot(innovation)
+                speed = np.hypot(*self.state[2:])
+                if speed > self.maxSpeed:
+                    self.state[2:] *= self.maxSpeed / speed
+                self.covariance = (np.eye(4) - gain.dot(np.eye(2, 4))).dot(self.covariance)
+                self.missCount = 0
+                return
+
+        # Far from the track: outliers while the track is healthy, otherwise the ball has been moved.
+        self.missCount += 1
+        if not self.is_tracking:
+            self.__start(*self.__measurement(*measurements[0]))
+
+    def predict(self, now, odometry=None):
+        """
+        Move the track forward to the given time and odometry.
+
+        :arg:
+            :param now: time in seconds
+            :type now: float
+            :param odometry: [x, y, theta] from ALMotion.getRobotPosition(), None if the robot has not moved
+            :type odometry: tuple
+        :return: None
+        """
+        last_odometry = self._odometry
+        if odometry is not None:
+            self._odometry = odometry
+        if self.state is None:
+            self.timestamp = now
+            return
+        dt = max(0.0, now - self.timestamp)
+        self.timestamp = now
+        # The velocity decays towards zero and its variance towards velocity_sigma^2 (Ornstein-Uhlenbeck),
+        # the position moves by at most velocity_time times the velocity however long the gap.
+        decay = np.exp(-dt / self.velocityTime)
+        transition = np.eye(4)
+        transition[0, 2] = transition[1, 3] = self.velocityTime * (1 - decay)
+        transition[2, 2] = transition[3, 3] = decay
+        process_noise = np.zeros((4, 4))
+        process_noise[2, 2] = process_noise[3, 3] = self.velocitySigma ** 2 * (1 - decay ** 2)
+        if odometry is not None:
+            walked = np.hypot(odometry[0] - last_odometry[0], odometry[1] - last_odometry[1])
+            turn = odometry[2] - last_odometry[2]
+            turned = abs(np.arctan2(np.sin(turn), np.cos(turn)))
+            # A heading error moves the ball sideways by its distance.
+            distance = np.hypot(*(self.state[:2] - odometry[:2]))
+            sigma = np.hypot(self.odometrySigmaPerMeter * walked, self.odometrySigmaPerRad * turned * distance)
+            process_noise[0, 0] = process_noise[1, 1] = sigma ** 2
+        self.state = transition.dot(self.state)
+        self.covariance = transition.dot(self.covariance).dot(transition.T) + process_noise
+
+    def __measurement(self, dis_x, dis_y):
+        """
+        Get a detection in the odometry frame and its noise.
+
+        :return:
+            (measurement, 2 * 2 noise covariance)
+            :rtype: tuple
+        """
+        sigma = self.measureSigma + self.measureSigmaPerMeter * np.hypot(dis_x, dis_y)
+        return self.__to_odometry(dis_x, dis_y), np.eye(2) * sigma ** 2
+
+    def __start(self, measurement, noise):
+        """
+        Start a new track at a detection, the ball is assumed still.
+
+        :return: None
+        """
+        self.state = np.array([measurement[0], measurement[1], 0.0, 0.0])
+        self.covariance = np.diag([noise[0, 0], noise[1, 1], self.velocitySigma ** 2, self.velocitySigma ** 2])
+        self.missCount = 0
+
+    def __to_odometry(self, dis_x, dis_y):
+        """
+        Move a point from the current robot frame into the odometry frame.
+
+        :return:
+            [x, y]
+            :rtype: np.ndarray
+        """
+        x, y, theta = self._odometry
+        return np.array([x + dis_x * np.cos(theta) - dis_y * np.sin(theta),
+                         y + dis_x * np.sin(theta) + dis_y * np.cos(theta)])
+
+    def __rotation(self):
+        """
+        Rotation from the odometry frame to the current robot frame.
+
+        :return:
+            2 * 2 rotation
+            :rtype: np.ndarray
+        """
+        theta = self._odometry[2]
+        return np.array([[np.cos(theta), np.sin(theta)], [-np.sin(theta), np.cos(theta)]])
+
+    @property
+    def is_tracking(self):
+        """
+        Whether the track is usable, even if the ball has not been seen in the last frames.
+
+        :return:
+            True means usable else not.
+            :rtype: bool
+        """
+        return (self.state is not None and self.missCount <= self.maxCoast and
+                np.sqrt(np.linalg.eigvalsh(self.covariance[:2, :2]).max()) <= self.maxSigma)
+
+    @property
+    def position(self):
+        """
+        Get the filtered ball position in the current robot frame, at the odometry of the last update.
+
+        :return:
+            [disX, disY, angle], zeros if there is no usable track
+            :rtype: list
+        """
+        if not self.is_tracking:
+            return [0, 0, 0]
+        x, y = self._odometry[:2]
+        dis_x, dis_y = self.__rotation().dot(self.state[:2] - (x, y))
+        return [float(dis_x), float(dis_y), float(np.arctan2(dis_y, dis_x))]
+
+    @property
+    def velocity(self):
+        """
+        Get the filtered ball velocity in the current robot frame.
+
+        :return:
+            [vx, vy] in m/s, zeros if there is no usable track
+            :rtype: list
+        """
+        if not self.is_tracking:
+            return [0, 0]
+        return [float(value) for value in self.__rotation().dot(self.state[2:])]
+
+    @property
+    def position_covariance(self):
+        """
+        Get the covariance of the filtered position in the current robot frame.
+
+        :return:
+            2 * 2 covariance in m^2, None if there is no track
+            :rtype: np.ndarray
+        """
+        if self.state is None:
+            return None
+        rotation = self.__rotation()
+        return rotation.dot(self.covariance[:2, :2]).dot(rotation.T)
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2023/12/09 14:05
+@Author  : Evan Wong
+@File    : color_table.py
+@Project : NAOGolf
+@Description: Lookup tables labelling red ball and yellow stick pixels in one pass over an HSV image
+"""
+
+import collections
+
+import cv2
+import numpy as np
+
+# Default thresholds of GolfBallDetect (two red hue bands) and StickDetect (yellow)
+BALL_HSV_RANGES = ((np.array([0, 43, 46]), np.array([10, 255, 255])),
+                   (np.array([156, 43, 46]), np.array([180, 255, 255])))
+STICK_HSV_RANGES = ((np.array([45, 75, 51]), np.array([70, 255, 255])),)
+
+BALL_CLASS = "ball"
+STICK_CLASS = "stick"
+
+_TABLE_CACHE_SIZE = 16
+_tables = collections.OrderedDict()
+
+
+class ColorTable(object):
+    """
+    Packed per-channel lookup table over H, S and V.
+
+    Every threshold box owns one bit, the table of a channel sets the bit for the values inside the box.
+    A pixel is inside a box when the bit survives the AND of its three channel entries,
+    which gives exactly the result of cv2.inRange for every box at once.
+    """
+
+    def __init__(self, ball_ranges, stick_ranges):
+        """
+        Initialization.
+
+        :arg:
+            :param ball_ranges: (min_hsv, max_hsv) pairs of the ball
+            :type ball_ranges: tuple
+            :param stick_ranges: (min_hsv, max_hsv) pairs of the stick
+            :type stick_ranges: tuple
+        :return: None
+        :raise: ValueError
+        """
+        boxes = [(BALL_CLASS, box) for box in ball_ranges] + [(STICK_CLASS, box) for box in stick_ranges]
+        if len(boxes) > 8:
+            raise ValueError("At most 8 HSV ranges fit in one color table")
+
+        self.key = table_key(ball_ranges, stick_ranges)
+        self.lut = np.zeros((1, 256, 3), np.uint8)
+        class_bits = {BALL_CLASS: 0, STICK_CLASS: 0}
+        values = np.arange(256)
+        for bit, (class_name, (min_hsv, max_hsv)) in enumerate(boxes):
+            for channel in range(3):
+                inside = (values >= min_hsv[channel]) & (values <= max_hsv[channel])
+                self.lut[0, inside, channel] |= 1 << bit
+            class_bits[class_name] |= 1 << bit
+
+        # Label -> 255 / 0 mask of each class
+        labels = np.arange(256)
+        self.classLuts = dict((class_name, np.uint8(np.where(labels & bits, 255, 0)))
+                              for class_name, bits in class_bits.items())
+
+    def classify(self, hsv_img, dst=None, scratch=None):
+        """
+        Label every pixel of an HSV image with the bits of the threshold boxes containing it.
+
+        :arg:
+            :param hsv_img: HSV image, the whole frame or a part of it
+            :type hsv_img: np.ndarray
+            :param dst: label image to write into, None to allocate it
+            :type dst: np.ndarray
+            :param scratch: (image shaped like hsv_img, [3 images shaped like dst]) for the intermediate results,
+                            None to allocate them
+            :type scratch: tuple
+        :return:
+            label image shaped height * width
+            :rtype: np.ndarray
+        """
+        if scratch is None:
+            h, s, v = cv2.split(cv2.LUT(hsv_img, self.lut))
+        else:
+            h, s, v = cv2.split(cv2.LUT(hsv_img, self.lut, dst=scratch[0]), scratch[1])
+        labels = cv2.bitwise_and(h, s, dst=dst)
+        return cv2.bitwise_and(labels, v, dst=labels)
+
+    def mask(self, labels, class_name, dst=None):
+        """
+        Get the binary image of one class from a label image.
+
+        :arg:
+            :param labels: label image returned by classify()
+            :type labels: np.ndarray
+            :param class_name: BALL_CLASS or STICK_CLASS
+            :type class_name: str
+            :param dst: binary image to write into, None to allocate it
+            :type dst: np.ndarray
+        :return:
+            binary image, 255 for the pixels of the class
+            :rtype: np.ndarray
+        """
+        return cv2.LUT(labels, self.classLuts[class_name], dst=dst)
+
+
+def table_key(ball_ranges, stick_ranges):
+    """
+    Hashable key of a threshold set.
+
+    :arg:
+        :param ball_ranges: (min_hsv, max_hsv) pairs of the ball
+        :type ball_ranges: tuple
+        :param stick_ranges: (min_hsv, max_hsv) pairs of the stick
+        :type stick_ranges: tuple
+    :return:
+        the key
+        :rtype: tuple
+    """
+    def ranges_key(ranges):
+        return tuple((tuple(int(value) for value in min_hsv), tuple(int(value) for value in max_hsv))
+                     for min_hsv, max_hsv in ranges)
+
+    return ranges_key(ball_ranges), ranges_key(stick_ranges)
+
+
+def get_color_table(ball_ranges=BALL_HSV_RANGES, stick_ranges=STICK_HSV_RANGES):
+    """
+    Get the color table of a threshold set, tables are built once and cached.
+
+    :arg:
+        :param ball_ranges: (min_hsv, max_hsv) pairs of the ball
+        :type ball_ranges: tuple
+        :param stick_ranges: (min_hsv, max_hsv) pairs of the stick
+        :type stick_ranges: tuple
+    :return:
+        the color table
+        :rtype: ColorTable
+    """
+    key = table_key(ball_ranges, stick_ranges)
+    table = _tables.pop(key, None)
+    if table is None:
+        table = ColorTable(ball_ranges, stick_ranges)
+        if len(_tables) >= _TABLE_CACHE_SIZE:
+            _tables.popitem(last=False)
+    _tables[key] = table
+    return table
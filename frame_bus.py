@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2023/12/05 10:42
+@Author  : Evan Wong
+@File    : frame_bus.py
+@Project : NAOGolf
+@Description: A shared frame source capturing once per tick for all the registered detectors
+"""
+
+import numpy as np
+import vision_definitions as vd
+
+from naoqi import ALProxy
+from nao_configure import NAOConfigure
+from frame_grabber import FrameGrabber, grab_image, grab_images
+
+DUAL_CAMERAS = (vd.kTopCamera, vd.kBottomCamera)
+
+
+class Frame(object):
+    """
+    One captured image tagged with its frame id and camera id.
+    """
+
+    def __init__(self, frame_id, camera_id, width, height, channels, timestamp, array):
+        """
+        Initialization.
+
+        :arg:
+            :param frame_id: id of the frame, increasing with every capture
+            :type frame_id: int
+            :param camera_id: bottom camera (1) or top camera (0)
+            :type camera_id: int
+            :param width: width of the image
+            :type width: int
+            :param height: height of the image
+            :type height: int
+            :param channels: channels of the image
+            :type channels: int
+            :param timestamp: capture time of the image in seconds
+            :type timestamp: float
+            :param array: image data shaped height * width * channels
+            :type array: np.ndarray
+        :return: None
+        """
+        self.frameID = frame_id
+        self.cameraID = camera_id
+        self.width = width
+        self.height = height
+        self.channels = channels
+        self.timestamp = timestamp
+        self.array = array
+        # Data derived from this frame which every detector can share, such as color labels.
+        self.cache = {}
+
+    @classmethod
+    def from_image(cls, frame_id, camera_id, image):
+        """
+        Build a frame from the image container returned by getImageRemote, no data is copied.
+
+        :arg:
+            :param frame_id: id of the frame
+            :type frame_id: int
+            :param camera_id: bottom camera (1) or top camera (0)
+            :type camera_id: int
+            :param image: [width, height, channels, colorSpace, seconds, microseconds, data, ...]
+            :type image: list
+        :return:
+            the frame, None if the image is invalid
+            :rtype: Frame
+        """
+        try:
+            width, height, channels = image[0], image[1], image[2]
+            timestamp = image[4] + image[5] * 1e-6
+            array = np.frombuffer(image[6], dtype=np.uint8).reshape([height, width, channels])
+        except (IndexError, TypeError, ValueError):
+            return None
+        return cls(frame_id, camera_id, width, height, channels, timestamp, array)
+
+
+class FrameBus(NAOConfigure):
+    """
+    Capture a frame once per tick and share it with every registered detector, inherits from NAOConfigure class.
+    """
+
+    def __init__(self, ip, port=9559, resolution=vd.kVGA, dual=False):
+        """
+        Initialization.
+
+        :arg:
+            :param ip: the ip address of a NAO robot
+            :type ip: str
+            :param port: the port to connect NAO robot (9559, default)
+            :type port: int
+            :param resolution: kVGA, default: 640*480
+            :type resolution: int
+            :param dual: whether every tick captures the top and bottom cameras together
+            :type dual: bool
+        :return: None
+        """
+        super(FrameBus, self).__init__(ip, port)
+        self.dual = dual
+        self.resolution = resolution
+        self.colorSpace = vd.kHSVColorSpace
+        self.fps = 30
+        self.frameID = 0
+        self.detectors = []
+        self._frames = {}
+        self._grabbers = {}
+        self._grabberCounts = {}
+
+    def register(self, detector):
+        """
+        Register a detector, its update_frame() will read frames from this bus.
+
+        :arg:
+            :param detector: the detector to register
+            :type detector: VisualBasis
+        :return: None
+        """
+        if detector not in self.detectors:
+            self.detectors.append(detector)
+            detector.attach_frame_source(self)
+
+    def unregister(self, detector):
+        """
+        Unregister a detector, it will grab its own frames again.
+
+        :arg:
+            :param detector: the detector to unregister
+            :type detector: VisualBasis
+        :return: None
+        """
+        if detector in self.detectors:
+            self.detectors.remove(detector)
+            detector.attach_frame_source(None)
+
+    def start_streaming(self, client="frame-bus", camera_ids=None, buffer_size=3):
+        """
+        Keep the cameras subscribed and grab them in background threads.
+
+        :arg:
+            :param client: client name
+            :type client: str
+            :param camera_ids: cameras to stream, the cameras of all registered detectors if None,
+                               ignored in dual mode where both cameras share one subscription
+            :type camera_ids: list
+            :param buffer_size: how many of the latest frames are kept
+            :type buffer_size: int
+        :return: None
+        """
+        if self.dual:
+            camera_ids = [DUAL_CAMERAS]
+        elif camera_ids is None:
+            camera_ids = set(detector.cameraID for detector in self.detectors)
+        for camera_id in camera_ids:
+            if camera_id in self._grabbers:
+                continue
+            grabber = FrameGrabber(ALProxy("ALVideoDevice", self.ip, self.port), client + str(len(self._grabbers)),
+                                   camera_id, self.resolution, self.colorSpace, self.fps, buffer_size)
+            grabber.start()
+            self._grabbers[camera_id] = grabber
+            self._grabberCounts[camera_id] = 0
+
+    def stop_streaming(self):
+        """
+        Stop all the background grabbers.
+
+        :return: None
+        """
+        for grabber in self._grabbers.values():
+            grabber.stop()
+        self._grabbers = {}
+        self._grabberCounts = {}
+
+    @property
+    def is_streaming(self):
+        """
+        Whether any camera is streamed in background.
+
+        :return:
+            True means streaming else not.
+            :rtype: bool
+        """
+        return len(self._grabbers) != 0
+
+    def _capture(self, camera_id, client):
+        """
+        Capture one image from the given camera.
+
+        :arg:
+            :param camera_id: bottom camera (1) or top camera (0)
+            :type camera_id: int
+            :param client: client name
+            :type client: str
+        :return:
+            image container returned by getImageRemote, None if failed
+            :rtype: list
+        """
+        grabber = self._grabbers.get(camera_id)
+        if grabber is not None:
+            self._grabberCounts[camera_id], image = grabber.latest(self._grabberCounts[camera_id])
+            return image
+        return grab_image(self.cameraProxy, client, camera_id, self.resolution, self.colorSpace, self.fps)
+
+    def capture_pair(self, client="frame-bus"):
+        """
+        Capture the top and bottom cameras in one synchronized call, no camera switching is needed.
+
+        :arg:
+            :param client: client name
+            :type client: str
+        :return:
+            (top frame, bottom frame), a frame is None if capturing failed
+            :rtype: tuple
+        """
+        grabber = self._grabbers.get(DUAL_CAMERAS)
+        if grabber is not None:
+            self._grabberCounts[DUAL_CAMERAS], images = grabber.latest(self._grabberCounts[DUAL_CAMERAS])
+        else:
+            images = grab_images(self.cameraProxy, client, DUAL_CAMERAS, self.resolution, self.colorSpace, self.fps)
+        if not images or len(images) != len(DUAL_CAMERAS):
+            images = [None] * len(DUAL_CAMERAS)
+
+        # Both frames of a pair share one id.
+        self.frameID += 1
+        for camera_id, image in zip(DUAL_CAMERAS, images):
+            self._frames[camera_id] = Frame.from_image(self.frameID, camera_id, image)
+        return self._frames[vd.kTopCamera], self._frames[vd.kBottomCamera]
+
+    def tick(self, camera_id=vd.kBottomCamera, client="frame-bus"):
+        """
+        Capture a new frame from the given camera and publish it to the registered detectors using that camera,
+        in dual mode both cameras are captured and published.
+
+        :arg:
+            :param camera_id: bottom camera (1, default) or top camera (0)
+            :type camera_id: int
+            :param client: client name
+            :type client: str
+        :return:
+            the new frame, None if capturing failed
+            :rtype: Frame
+        """
+        if self.dual:
+            self.capture_pair(client)
+            return self._frames[camera_id]
+
+        self.frameID += 1
+        frame = Frame.from_image(self.frameID, camera_id, self._capture(camera_id, client))
+        self._frames[camera_id] = frame
+        return frame
+
+    def get_frame(self, camera_id, newer_than=0, client="frame-bus"):
+        """
+        Get the frame of current tick for a detector, a new tick starts when the detector has seen it already.
+
+        :arg:
+            :param camera_id: bottom camera (1) or top camera (0)
+            :type camera_id: int
+            :param newer_than: id of the last frame the detector has processed
+            :type newer_than: int
+            :param client: client name
+            :type client: str
+        :return:
+            the frame, None if capturing failed
+            :rtype: Frame
+        """
+        frame = self._frames.get(camera_id)
+        if frame is None or frame.frameID <= newer_than:
+            frame = self.tick(camera_id, client)
+        return frame
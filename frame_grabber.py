@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2023/12/04 15:20
+@Author  : Evan Wong
+@File    : frame_grabber.py
+@Project : NAOGolf
+@Description: Background thread keeping a camera subscription alive and buffering the latest frames
+"""
+
+import time
+import threading
+import collections
+
+
+def grab_image(camera_proxy, client, camera_id, resolution, color_space, fps):
+    """
+    Subscribe a camera, get one image and unsubscribe it.
+
+    :arg:
+        :param camera_proxy: ALVideoDevice proxy
+        :type camera_proxy: ALProxy
+        :param client: client name
+        :type client: str
+        :param camera_id: bottom camera (1) or top camera (0)
+        :type camera_id: int
+        :param resolution: resolution of the subscription, such as kVGA
+        :type resolution: int
+        :param color_space: color space of the subscription, such as kHSVColorSpace
+        :type color_space: int
+        :param fps: frame rate of the subscription
+        :type fps: int
+    :return:
+        image container returned by getImageRemote
+        :rtype: list
+    """
+    video_client = camera_proxy.subscribeCamera(client, camera_id, resolution, color_space, fps)
+    image = camera_proxy.getImageRemote(video_client)
+    camera_proxy.unsubscribe(video_client)
+    return image
+
+
+def grab_images(camera_proxy, client, camera_ids, resolution, color_space, fps):
+    """
+    Subscribe several cameras at once, get one synchronized image from each and unsubscribe them.
+
+    :arg:
+        :param camera_proxy: ALVideoDevice proxy
+        :type camera_proxy: ALProxy
+        :param client: client name
+        :type client: str
+        :param camera_ids: cameras to capture, such as [kTopCamera, kBottomCamera]
+        :type camera_ids: list
+        :param resolution: resolution of the subscription, such as kVGA
+        :type resolution: int
+        :param color_space: color space of the subscription, such as kHSVColorSpace
+        :type color_space: int
+        :param fps: frame rate of the subscription
+        :type fps: int
+    :return:
+        image containers in the order of camera_ids
+        :rtype: list
+    """
+    count = len(camera_ids)
+    video_client = camera_proxy.subscribeCameras(client, list(camera_ids), [resolution] * count,
+                                                 [color_space] * count, fps)
+    images = camera_proxy.getImagesRemote(video_client)
+    camera_proxy.unsubscribe(video_client)
+    return images
+
+
+class FrameGrabber(threading.Thread):
+    """
+    A daemon thread which subscribes a camera once and keeps pulling images into a small ring buffer.
+    When a list of cameras is given, they are subscribed together and every buffered entry is a list of images.
+    """
+
+    def __init__(self, camera_proxy, client, camera_id, resolution, color_space, fps, buffer_size=3):
+        """
+        Initialization.
+
+        :arg:
+            :param camera_proxy: a dedicated ALVideoDevice proxy used only by this thread
+            :type camera_proxy: ALProxy
+            :param client: client name
+            :type client: str
+            :param camera_id: bottom camera (1) or top camera (0), or a list of them
+            :type camera_id: int | list
+            :param resolution: resolution of the subscription, such as kVGA
+            :type resolution: int
+            :param color_space: color space of the subscription, such as kHSVColorSpace
+            :type color_space: int
+            :param fps: frame rate of the subscription
+            :type fps: int
+            :param buffer_size: how many of the latest frames are kept
+            :type buffer_size: int
+        :return: None
+        """
+        super(FrameGrabber, self).__init__(name="FrameGrabber-" + client)
+        self.daemon = True
+        self.cameraProxy = camera_proxy
+        self.client = client
+        self.cameraID = camera_id
+        self.isMulti = isinstance(camera_id, (list, tuple))
+        self.resolution = resolution
+        self.colorSpace = color_space
+        self.fps = fps
+        self.videoClient = None
+        self.frameCount = 0
+        self._buffer = collections.deque(maxlen=buffer_size)
+        self._condition = threading.Condition()
+        self._running = threading.Event()
+
+    def start(self):
+        """
+        Subscribe the camera and start grabbing.
+
+        :return: None
+        """
+        if self.isMulti:
+            count = len(self.cameraID)
+            self.videoClient = self.cameraProxy.subscribeCameras(self.client, list(self.cameraID),
+                                                                 [self.resolution] * count,
+                                                                 [self.colorSpace] * count, self.fps)
+        else:
+            self.videoClient = self.cameraProxy.subscribeCamera(self.client, self.cameraID,
+                                                                self.resolution, self.colorSpace, self.fps)
+        self._running.set()
+        super(FrameGrabber, self).start()
+
+    def run(self):
+        """
+        Grabbing loop, only new images (judged by their timestamps) are pushed into the buffer.
+
+        :return: None
+        """
+        period = 1.0 / self.fps
+        last_stamp = None
+        while self._running.is_set():
+            try:
+                if self.isMulti:
+                    image = self.cameraProxy.getImagesRemote(self.videoClient)
+                else:
+                    image = self.cameraProxy.getImageRemote(self.videoClient)
+            except RuntimeError, e:
+                print "FrameGrabber: get image failed! " + str(e)
+                image = None
+            first = image[0] if image and self.isMulti else image
+            if not first or len(first) < 7:
+                time.sleep(period)
+                continue
+
+            stamp = (first[4], first[5])
+            if stamp == last_stamp:
+                time.sleep(period / 4)
+                continue
+            last_stamp = stamp
+
+            with self._condition:
+                self.frameCount += 1
+                self._buffer.append((self.frameCount, image))
+                self._condition.notify_all()
+
+    def latest(self, newer_than=0, timeout=1.0):
+        """
+        Get the latest image in the buffer, waiting for one newer than the given frame count if needed.
+
+        :arg:
+            :param newer_than: frame count of the last image the caller has consumed
+            :type newer_than: int
+            :param timeout: maximum seconds to wait for a newer image
+            :type timeout: float
+        :return:
+            (frame count, naoqi image container or list of them), (newer_than, None) if nothing arrived in time
+            :rtype: tuple
+        """
+        deadline = time.time() + timeout
+        with self._condition:
+            while self.frameCount <= newer_than:
+                remaining = deadline - time.time()
+                if remaining <= 0 or not self._running.is_set():
+                    break
+                self._condition.wait(remaining)
+            if not self._buffer or self._buffer[-1][0] <= newer_than:
+                return newer_than, None
+            return self._buffer[-1]
+
+    def stop(self):
+        """
+        Stop grabbing and release the subscription.
+
+        :return: None
+        """
+        self._running.clear()
+        with self._condition:
+            self._condition.notify_all()
+        if self.is_alive():
+            self.join(2.0)
+        if self.videoClient is not None:
+            self.cameraProxy.unsubscribe(self.videoClient)
+            self.videoClient = None
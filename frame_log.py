@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2023/12/06 20:15
+@Author  : Evan Wong
+@File    : frame_log.py
+@Project : NAOGolf
+@Description: Record raw frames with their pose into a binary log and replay them without a robot
+"""
+
+import os
+import mmap
+import struct
+
+import numpy as np
+
+from frame_bus import Frame
+from pose_snapshot import transform_from_6d
+
+FILE_MAGIC = "NAOFLOG1"
+RECORD_MAGIC = "FREC"
+# magic, payload size, timestamp, camera id, width, height, channels, head yaw, head pitch, camera pose (6D)
+RECORD_HEADER = struct.Struct("<4sIdiHHH2x2f6f")
+
+
+class FrameRecord(object):
+    """
+    One record of the frame log: a frame plus the pose of the robot when it was captured.
+    """
+
+    def __init__(self, frame, head_angles, camera_pose):
+        """
+        Initialization.
+
+        :arg:
+            :param frame: the recorded frame
+            :type frame: Frame
+            :param head_angles: [HeadYaw, HeadPitch] in rad
+            :type head_angles: list
+            :param camera_pose: 6D position of the camera in FRAME_ROBOT, [x, y, z, wx, wy, wz]
+            :type camera_pose: list
+        :return: None
+        """
+        self.frame = frame
+        self.headAngles = head_angles
+        self.cameraPose = camera_pose
+
+
+class FrameRecorder(object):
+    """
+    Append raw frames and their pose to a binary log file.
+    """
+
+    def __init__(self, log_path):
+        """
+        Initialization, records are appended if the log exists already.
+
+        :arg:
+            :param log_path: path of the log file
+            :type log_path: str
+        :return: None
+        """
+        self.logPath = log_path
+        is_new = not os.path.exists(log_path) or os.path.getsize(log_path) == 0
+        self._file = open(log_path, "ab")
+        if is_new:
+            self._file.write(FILE_MAGIC)
+        self.recordCount = 0
+
+    def append(self, frame, head_angles, camera_pose):
+        """
+        Append one frame to the log.
+
+        :arg:
+            :param frame: the frame to record
+            :type frame: Frame
+            :param head_angles: [HeadYaw, HeadPitch] in rad
+            :type head_angles: list
+            :param camera_pose: 6D position of the camera in FRAME_ROBOT, [x, y, z, wx, wy, wz]
+            :type camera_pose: list
+        :return: None
+        """
+        array = np.ascontiguousarray(frame.array, dtype=np.uint8)
+        header = RECORD_HEADER.pack(RECORD_MAGIC, array.nbytes, frame.timestamp, frame.cameraID,
+                                    frame.width, frame.height, frame.channels,
+                                    head_angles[0], head_angles[1], *camera_pose[:6])
+        self._file.write(header)
+        array.tofile(self._file)
+        self.recordCount += 1
+
+    def close(self):
+        """
+        Flush and close the log file.
+
+        :return: None
+        """
+        self._file.close()
+
+
+class FrameLog(object):
+    """
+    Memory-mapped reader of a frame log, frames are views of the mapped file and never copied.
+    """
+
+    def __init__(self, log_path):
+        """
+        Initialization, the records are indexed once.
+
+        :arg:
+            :param log_path: path of the log file
+            :type log_path: str
+        :return: None
+        :raise: ValueError
+        """
+        self.logPath = log_path
+        self._file = open(log_path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(FILE_MAGIC)] != FILE_MAGIC:
+            raise ValueError(log_path + " is not a frame log")
+
+        self._offsets = []
+        offset = len(FILE_MAGIC)
+        size = len(self._map)
+        while offset + RECORD_HEADER.size <= size:
+            magic, payload_size = RECORD_HEADER.unpack_from(self._map, offset)[:2]
+            if magic != RECORD_MAGIC or offset + RECORD_HEADER.size + payload_size > size:
+                # A truncated tail, such as the recorder being killed while writing.
+                break
+            self._offsets.append(offset)
+            offset += RECORD_HEADER.size + payload_size
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def record(self, index):
+        """
+        Get a record of the log.
+
+        :arg:
+            :param index: index of the record
+            :type index: int
+        :return:
+            the record, its frame id is index + 1
+            :rtype: FrameRecord
+        """
+        offset = self._offsets[index]
+        fields = RECORD_HEADER.unpack_from(self._map, offset)
+        payload_size, timestamp, camera_id, width, height, channels = fields[1:7]
+        array = np.frombuffer(self._map, dtype=np.uint8, count=payload_size,
+                              offset=offset + RECORD_HEADER.size).reshape([height, width, channels])
+        frame = Frame(index + 1, camera_id, width, height, channels, timestamp, array)
+        return FrameRecord(frame, list(fields[7:9]), list(fields[9:15]))
+
+    def close(self):
+        """
+        Close the mapped file.
+
+        :return: None
+        """
+        self._map.close()
+        self._file.close()
+
+
+class ReplayMotion(object):
+    """
+    Stand-in of the ALMotion proxy answering pose queries with the pose recorded for the current replayed frame.
+    """
+
+    def __init__(self, replay):
+        """
+        Initialization.
+
+        :arg:
+            :param replay: the replay serving frames
+            :type replay: FrameReplay
+        :return: None
+        """
+        self.replay = replay
+
+    def getPosition(self, name, space, use_sensor_values):
+        """
+        Recorded camera pose, also used for "Head" whose yaw matches the camera's one.
+        """
+        return list(self.replay.current.cameraPose)
+
+    def getTransform(self, name, space, use_sensor_values):
+        """
+        Recorded camera pose as the 16 values of a transform, row major.
+        """
+        return [float(value) for value in transform_from_6d(self.replay.current.cameraPose).flat]
+
+    def getAngles(self, names, use_sensors):
+        """
+        Recorded head angles, only HeadYaw and HeadPitch are known.
+        """
+        if not isinstance(names, list):
+            names = [names]
+        angles = {"HeadYaw": self.replay.current.headAngles[0], "HeadPitch": self.replay.current.headAngles[1]}
+        return [angles[name] for name in names]
+
+
+class FrameReplay(object):
+    """
+    Frame source feeding the frames of a log back through VisualBasis.update_frame() with no robot connected.
+    """
+
+    def __init__(self, log_path, loop=False):
+        """
+        Initialization.
+
+        :arg:
+            :param log_path: path of the log file
+            :type log_path: str
+            :param loop: whether to start again from the first frame at the end of the log
+            :type loop: bool
+        :return: None
+        """
+        self.log = FrameLog(log_path)
+        self.loop = loop
+        self.current = None
+
+    def attach(self, detector):
+        """
+        Let a detector read frames and pose from this replay, the detector may be created with ip=None.
+
+        :arg:
+            :param detector: the detector to feed
+            :type detector: VisualBasis
+        :return: None
+        """
+        detector.attach_frame_source(self)
+        detector.attach_pose_snapshot(None)
+        detector.motionProxy = ReplayMotion(self)
+
+    def get_frame(self, camera_id, newer_than=0, client=None):
+        """
+        Get the next recorded frame of the given camera.
+
+        :arg:
+            :param camera_id: bottom camera (1) or top camera (0)
+            :type camera_id: int
+            :param newer_than: id of the last frame the detector has processed
+            :type newer_than: int
+            :param client: unused, kept for the frame source interface
+            :type client: str
+        :return:
+            the frame, None at the end of the log
+            :rtype: Frame
+        """
+        count = len(self.log)
+        start = newer_than if newer_than < count or not self.loop else 0
+        for index in range(start, count) + (range(0, start) if self.loop else []):
+            record = self.log.record(index)
+            if record.frame.cameraID == camera_id:
+                self.current = record
+                return record.frame
+        return None
+
+    def close(self):
+        """
+        Close the log.
+
+        :return: None
+        """
+        self.log.close()
@@ -12,9 +12,21 @@ import numpy as np
 import vision_definitions as vd
 
 from visual_basis import VisualBasis
+from color_table import BALL_CLASS, STICK_HSV_RANGES, get_color_table
+from ground_projection import BOTTOM_CAMERA_DIRECTION, GroundProjectionTable, ground_to_pixel
 
+# Circle detection engines of GolfBallDetect
+BALL_ENGINES = ("components", "hough")
 
-def find_circles(preprocessed_img, min_dist, min_radius, max_radius):
+# Ranked ball candidates of a frame, see GolfBallDetect.ball_candidates
+BALL_CANDIDATE_DTYPE = np.dtype([("centerX", np.int32), ("centerY", np.int32), ("radius", np.int32),
+                                 ("score", np.float32), ("disX", np.float64), ("disY", np.float64),
+                                 ("angle", np.float64), ("confidence", np.float32)])
+# Ratio of red pixels in the 4r * 4r window of an ideal ball
+BALL_RED_RATIO = 0.19
+
+
+def find_circles(preprocessed_img, min_dist, min_radius, max_radius, offset=(0, 0), param1=150, param2=15):
     """
     Detect circles from image.
 
@@ -27,6 +39,12 @@ def find_circles(preprocessed_img, min_dist, min_radius, max_radius):
         :type min_radius: float
         :param max_radius: maximum radius of circles
         :type max_radius: float
+        :param offset: (x, y) position of the image in the frame, added to the centers before rounding
+        :type offset: tuple
+        :param param1: higher threshold of the Canny edge detector
+        :type param1: float
+        :param param2: accumulator threshold of the circle centers, smaller finds more (false) circles
+        :type param2: float
     :return:
         an uint16 numpy array shaped circleNum * 3 if circleNum > 0, ([[circleX, circleY,radius]])
         else return None.
@@ -34,14 +52,94 @@ def find_circles(preprocessed_img, min_dist, min_radius, max_radius):
     """
     method = cv2.HOUGH_GRADIENT
     dp = 1
-    param1 = 150
-    param2 = 15
-    circles = cv2.HoughCircles(np.uint8(preprocessed_img), method, dp,
+    circles = cv2.HoughCircles(np.asarray(preprocessed_img, dtype=np.uint8), method, dp,
                                min_dist, param1=param1, param2=param2, minRadius=min_radius, maxRadius=max_radius)
 
     if circles is None:
         return np.uint16([])
-    return np.uint16(np.round(circles[0, ]))
+    circles = circles[0, ]
+    circles[:, 0] += offset[0]
+    circles[:, 1] += offset[1]
+    return np.uint16(np.round(circles))
+
+
+def find_circles_banded(preprocessed_img, min_dist, bands, offset=(0, 0), param1=150, param2=15):
+    """
+    Detect circles band by band of rows, each band with its own radius range.
+
+    :arg:
+        :param preprocessed_img: Pre-processed image to be detected
+        :type preprocessed_img: np.ndarray
+        :param min_dist: minium distance between the center of two circle
+        :type min_dist: float
+        :param bands: [(top, bottom, min_radius, max_radius), ...], rows of the image where the circle centers
+                      of each band lie
+        :type bands: list
+        :param offset: (x, y) position of the image in the frame, added to the centers before rounding
+        :type offset: tuple
+        :param param1: higher threshold of the Canny edge detector
+        :type param1: float
+        :param param2: accumulator threshold of the circle centers, smaller finds more (false) circles
+        :type param2: float
+    :return:
+        an uint16 numpy array shaped circleNum * 3
+        :rtype: np.ndarray
+    """
+    height = preprocessed_img.shape[0]
+    found = []
+    for top, bottom, min_radius, max_radius in bands:
+        # Search the rows a circle centred in the band covers, keep the circles centred in the band only.
+        y0 = max(0, top - max_radius)
+        y1 = min(height, bottom + max_radius)
+        if cv2.countNonZero(preprocessed_img[y0:y1]) == 0:
+            continue
+        circles = find_circles(preprocessed_img[y0:y1], min_dist, min_radius, max_radius,
+                               (offset[0], offset[1] + y0), param1, param2)
+        if circles.size:
+            centers_y = circles[:, 1].astype(np.int64) - offset[1]
+            found.append(circles[(centers_y >= top) & (centers_y < bottom)])
+    if len(found) == 0:
+        return np.uint16([])
+    return np.uint16(np.concatenate(found))
+
+
+def find_circles_components(binary_img, min_radius, max_radius, fill_range=(0.6, 1.15), min_aspect=0.75,
+                            offset=(0, 0)):
+    """
+    Detect filled discs from a binary image with connected components, much cheaper than Hough circle detection.
+
+    :arg:
+        :param binary_img: binary image to be detected
+        :type binary_img: np.ndarray
+        :param min_radius: minium radius of circles
+        :type min_radius: float
+        :param max_radius: maximum radius of circles
+        :type max_radius: float
+        :param fill_range: range of the ratio between the blob area and the area of the disc fitting its bounding
+                           box, about 1 for a disc, 4 / pi for a square
+        :type fill_range: tuple
+        :param min_aspect: minimum ratio between the short and the long side of the bounding box
+        :type min_aspect: float
+        :param offset: (x, y) position of the image in the frame, added to the centers before rounding
+        :type offset: tuple
+    :return:
+        (an uint16 numpy array shaped circleNum * 3, whether the result is ambiguous),
+        ambiguous means some blobs have the size of a ball but not its shape, such as a ball touching clutter
+        :rtype: tuple
+    """
+    _, _, stats, centroids = cv2.connectedComponentsWithStats(binary_img)
+    stats, centroids = stats[1:], centroids[1:]
+    widths = stats[:, cv2.CC_STAT_WIDTH].astype(np.float64)
+    heights = stats[:, cv2.CC_STAT_HEIGHT].astype(np.float64)
+    radius = (widths + heights) / 4
+    sized = (radius >= min_radius) & (radius <= max_radius)
+    fill = stats[:, cv2.CC_STAT_AREA] / (np.pi * radius ** 2)
+    aspect = np.minimum(widths, heights) / np.maximum(widths, heights)
+    is_disc = sized & (fill >= fill_range[0]) & (fill <= fill_range[1]) & (aspect >= min_aspect)
+
+    circles = np.c_[centroids[is_disc, 0] + offset[0], centroids[is_disc, 1] + offset[1], radius[is_disc]]
+    is_ambiguous = not is_disc.any() and sized.any()
+    return np.uint16(np.round(circles)), is_ambiguous
 
 
 class GolfBallDetect(VisualBasis):
@@ -62,7 +160,9 @@ class GolfBallDetect(VisualBasis):
             self.ballPosition = {"disX": 0, "disY": 0, "angle": 0}
             self.ballRadius = 0.025
 
-    def __init__(self, ip, port=9559, camera_id=vd.kBottomCamera, resolution=vd.kVGA, is_write=True):
+    def __init__(self, ip, port=9559, camera_id=vd.kBottomCamera, resolution=vd.kVGA, is_write=True,
+                 coarse_scale=1, is_tracking=False, max_misses=3, engine="components", radius_bands=4,
+                 is_horizon_crop=True):
         """
         Initialization.
 
@@ -77,43 +177,200 @@ class GolfBallDetect(VisualBasis):
             :type resolution: int
             :param is_write: whether write current frame to specific directory, we actually not used it
             :type is_write: bool
+            :param coarse_scale: downscale factor of the coarse search, 1 (default) searches the full frame only,
+                                 2 finds candidates in QVGA and detects circles in full resolution windows
+            :type coarse_scale: int
+            :param is_tracking: whether to search only around the predicted ball once it has been found
+            :type is_tracking: bool
+            :param max_misses: misses in the predicted region before searching the full frame again
+            :type max_misses: int
+            :param engine: circle detection engine, "components" (default, Hough as fallback) or "hough"
+            :type engine: str
+            :param radius_bands: bands of rows the full frame Hough detection is split into, each searching the
+                                 radius expected for a ball on the ground there, 1 for one global radius range
+            :type radius_bands: int
+            :param is_horizon_crop: whether to search only the rows below the horizon seen by the camera
+            :type is_horizon_crop: bool
         :return: None
+        :raise: ValueError
         """
+        if engine not in BALL_ENGINES:
+            raise ValueError("engine must be one of " + ", ".join(BALL_ENGINES))
         super(GolfBallDetect, self).__init__(ip, port, camera_id, resolution)
         self.golfBall = self.GolfBall()
+        self.engine = engine
         self.isWrite = is_write
-
-    def __get_preprocessed_image(self, low_min_hsv, low_max_hsv, high_min_hsv, high_max_hsv):
+        self.coarseScale = coarse_scale
+        self.maxRefinedCandidates = 8
+        self.isTracking = is_tracking
+        self.maxMisses = max_misses
+        self.missCount = 0
+        self.trackState = None
+        self.groundTable = None
+        self.ballCandidates = np.zeros(0, BALL_CANDIDATE_DTYPE)
+        # Parameters of cv2.HoughCircles, tuned offline with param_sweep.py
+        self.houghParams = {"param1": 150, "param2": 15}
+        self.radiusBands = radius_bands
+        # Relative error allowed around the expected radius: camera height, lateral position in the frame...
+        self.radiusTolerance = 0.4
+        self.isHorizonCrop = is_horizon_crop
+        # Rows kept above the horizon for the errors of the pose
+        self.horizonMargin = 20
+
+    def __get_preprocessed_image(self, labels, color_table):
         """
-        Get pre-processed binary image from the HSV image (transformed from BGR image).
+        Get pre-processed binary image from the color labels of the HSV image.
 
         :arg:
-            :param low_min_hsv: Lower threshold for lower range red tones
-            :type low_max_hsv: np.ndarray
-            :param low_max_hsv: Higher threshold for lower range red tones
-            :type low_max_hsv: np.ndarray
-            :param high_min_hsv: Lower threshold for higher range red tones
-            :type high_min_hsv: np.ndarray
-            :param high_max_hsv: Higher threshold for higher range red tones
-            :type high_max_hsv: np.ndarray
+            :param labels: color labels of the whole frame or a part of it
+            :type labels: np.ndarray
+            :param color_table: color table the labels were computed with
+            :type color_table: ColorTable
         :return:
             pre-processed binary image
             :rtype: np.ndarray
         """
-        hsv_img = self.frame_array
-        lower_ranged_frame = cv2.inRange(hsv_img, low_min_hsv, low_max_hsv)
-        higher_ranged_frame = cv2.inRange(hsv_img, high_min_hsv, high_max_hsv)
-        merged_frame = np.maximum(lower_ranged_frame, higher_ranged_frame)
+        with self._stage("classify"):
+            merged_frame = self.pipeline.mask(color_table, labels, BALL_CLASS)
+
+        with self._stage("morphology"):
+            opened_frame = self.pipeline.close_open(merged_frame, 5)
+
+        return opened_frame
+
+    def __detect_circles(self, binary_img, min_dist, min_radius, max_radius, offset=(0, 0), stand_state=None):
+        """
+        Detect circles in a pre-processed binary image with the selected engine,
+        Hough circle detection is the fallback when the connected components are ambiguous.
+
+        :arg:
+            :param binary_img: pre-processed binary image, the whole frame or a part of it
+            :type binary_img: np.ndarray
+            :param min_dist: minium distance between the center of two circle
+            :type min_dist: float
+            :param min_radius: minium radius of circles
+            :type min_radius: float
+            :param max_radius: maximum radius of circles
+            :type max_radius: float
+            :param offset: (x, y) position of the image in the frame
+            :type offset: tuple
+            :param stand_state: Stand state of NAO robot to search every band of rows for the radius expected
+                                there, None for one global radius range
+            :type stand_state: str
+        :return:
+            an uint16 numpy array shaped circleNum * 3
+            :rtype: np.ndarray
+        """
+        if self.engine == "components":
+            with self._stage("circles"):
+                circles, is_ambiguous = find_circles_components(binary_img, min_radius, max_radius, offset=offset)
+            if not is_ambiguous:
+                return circles
 
         kernel_size = (9, 9)
-        kernel = np.ones((5, 5), np.uint8)
         sigma_x = 1.5
+        with self._stage("blur"):
+            blured_frame = self.pipeline.blur(binary_img, kernel_size, sigma_x)
+        with self._stage("circles"):
+            bands = self.__radius_bands(stand_state, offset[1], offset[1] + binary_img.shape[0], min_radius,
+                                        max_radius) if stand_state is not None else None
+            if bands is None:
+                return find_circles(blured_frame, min_dist, min_radius, max_radius, offset, **self.houghParams)
+            bands = [(top - offset[1], bottom - offset[1], band_min, band_max)
+                     for top, bottom, band_min, band_max in bands]
+            return find_circles_banded(blured_frame, min_dist, bands, offset, **self.houghParams)
+
+    def __radius_bands(self, stand_state, top, bottom, min_radius, max_radius):
+        """
+        Split rows of the frame into bands with the radius range of a ball on the ground centred in each band,
+        from the camera model. Bands where the ball would not fit the global range are left out.
 
-        closed_frame = cv2.morphologyEx(merged_frame, cv2.MORPH_CLOSE, kernel)
-        opened_frame = cv2.morphologyEx(closed_frame, cv2.MORPH_OPEN, kernel)
-        blured_frame = cv2.GaussianBlur(opened_frame, kernel_size, sigma_x)
+        :arg:
+            :param stand_state: Stand state of NAO robot, "standInit" or "standUp"
+            :type stand_state: str
+            :param top: first row
+            :type top: int
+            :param bottom: row after the last row
+            :type bottom: int
+            :param min_radius: minium radius of circles
+            :type min_radius: int
+            :param max_radius: maximum radius of circles
+            :type max_radius: int
+        :return:
+            [(top, bottom, min_radius, max_radius), ...] in frame rows, None to search one global range
+            :rtype: list
+        """
+        if self.radiusBands < 2 or stand_state not in BOTTOM_CAMERA_DIRECTION:
+            return None
+        edges = np.linspace(top, bottom, self.radiusBands + 1).astype(np.int64)
+        rows = np.c_[edges[:-1], edges[1:] - 1].ravel()
+        # Rows at or above the horizon never see the ground, any ball size may show up there.
+        head_pitch = self.head_angles()[1]
+        ray_pitch = (BOTTOM_CAMERA_DIRECTION[stand_state] / 180 * np.pi + head_pitch +
+                     (rows - 1.0 * self.frameHeight / 2) * self.cameraPitchRange / self.frameHeight)
+        camera_position = self.camera_position("CameraBottom")
+        ball_x, ball_y, _ = self.localise_circles(np.c_[np.full(len(rows), self.frameWidth // 2), rows,
+                                                        np.zeros(len(rows))], stand_state, camera_position)
+        expected = self.__expected_radius(ball_x, ball_y, camera_position).reshape([-1, 2])
+        is_ground = (ray_pitch > 0.01).reshape([-1, 2]).all(axis=1)
+
+        bands = []
+        for i in range(self.radiusBands):
+            if not is_ground[i]:
+                bands.append((edges[i], edges[i + 1], min_radius, max_radius))
+                continue
+            band_min = max(min_radius, int(expected[i].min() * (1 - self.radiusTolerance)) - 1)
+            band_max = min(max_radius, int(np.ceil(expected[i].max() * (1 + self.radiusTolerance))) + 1)
+            if band_min <= band_max:
+                bands.append((edges[i], edges[i + 1], band_min, band_max))
+        return bands
 
-        return blured_frame
+    def __expected_radius(self, ball_x, ball_y, camera_position):
+        """
+        Radius in pixels of a ball on the ground at positions of the robot frame.
+
+        :arg:
+            :param ball_x: distances of the balls in x-axis
+            :type ball_x: np.ndarray
+            :param ball_y: distances of the balls in y-axis
+            :type ball_y: np.ndarray
+            :param camera_position: position of the bottom camera in FRAME_ROBOT
+            :type camera_position: list
+        :return:
+            the radius of each ball
+            :rtype: np.ndarray
+        """
+        camera_x, camera_y, camera_height = camera_position[:3]
+        distance = np.sqrt((ball_x - camera_x) ** 2 + (ball_y - camera_y) ** 2 +
+                           (camera_height - self.golfBall.ballRadius) ** 2)
+        return self.golfBall.ballRadius / distance * self.frameWidth / self.cameraYawRange
+
+    def localise_circles(self, circles, stand_state="standInit", camera_position=None):
+        """
+        Localise any number of circles on the ground with one lookup of the ground projection table.
+
+        :arg:
+            :param circles: circles in frame, [[centerX, centerY, radius], ...]
+            :type circles: np.ndarray
+            :param stand_state: Stand state of NAO robot, "standInit" or "standUp"
+            :type stand_state: str
+            :param camera_position: position of the bottom camera if already known, None to read it
+            :type camera_position: list
+        :return:
+            (disX, disY, angle) arrays, one item per circle
+            :rtype: tuple
+        :raise: KeyError
+        """
+        circles = np.asarray(circles).reshape([-1, 3])
+        frame_size = (self.frameWidth, self.frameHeight)
+        if self.groundTable is None or self.groundTable.frameSize != frame_size:
+            # The frame size is only known once a frame is loaded.
+            self.groundTable = GroundProjectionTable(frame_size, (self.cameraYawRange, self.cameraPitchRange),
+                                                     self.golfBall.ballRadius)
+        if camera_position is None:
+            camera_position = self.camera_position("CameraBottom")
+        return self.groundTable.localise(circles[:, 0], circles[:, 1], camera_position, self.head_angles(),
+                                         stand_state)
 
     def _update_ball_position(self, stand_state):
         """
@@ -124,56 +381,17 @@ class GolfBallDetect(VisualBasis):
             :type stand_state: str
         :return: None
         """
-        bottom_camera_direction = {"standInit": 49.2, "standUp": 39.7}
-        # 摄像机初始俯仰角？
-        ball_radius = self.golfBall.ballRadius
-        try:
-            camera_direction = bottom_camera_direction[stand_state]
-        except KeyError:
+        if stand_state not in BOTTOM_CAMERA_DIRECTION:
             print("Unknown stand state, please check the value of stand state!")
+        elif self.golfBall.ballData["radius"] == 0:
+            # But... How could it be zero?
+            self.golfBall.ballPosition = {"disX": 0, "disY": 0, "angle": 0}
         else:
-            if self.golfBall.ballData["radius"] == 0:
-                # But... How could it be zero?
-                self.golfBall.ballPosition = {"disX": 0, "disY": 0, "angle": 0}
-            else:
-                center_x = self.golfBall.ballData["centerX"]
-                center_y = self.golfBall.ballData["centerY"]
-                # radius = self.golfBall.ballData["radius"]
-
-                camera_position = self.motionProxy.getPosition("CameraBottom", 2, True)
-                # 2 means FRAME_ROBOT,
-                # True means the sensor values will be used to determine the position.
-                camera_x = camera_position[0]
-                camera_y = camera_position[1]
-                camera_height = camera_position[2]
-
-                head_pitches = self.motionProxy.getAngles("HeadPitch", True)
-                head_pitch = head_pitches[0]  # 偏航角
-                head_yaws = self.motionProxy.getAngles("HeadYaw", True)
-                head_yaw = head_yaws[0]  # 俯仰角
-                # 像素坐标系 -> 图片坐标系 -> 相机坐标系（angle）
-                ball_pitch = (center_y - 1.0 * self.frameHeight / 2) * self.cameraPitchRange / self.frameHeight
-                # y (pitch angle)
-                ball_yaw = (1.0 * self.frameWidth / 2 - center_x) * self.cameraYawRange / self.frameWidth
-                # x (yaw angle)
-                # 应是 (cameraHeight - ballRadius) / Pitch = np.tan(cameraDirection / 180 * np.pi + headPitch + ballPitch)
-                # cameraDirection为初始绝对角度，headPitch为运动角度，ballPitch球相对摄像机角度，相加即球相对NAO角度
-                # 故dPitch为球到NAO的距离，易得dYaw为球相对摄像机的位置，SA距离
-                d_pitch = ((camera_height - ball_radius) /
-                           np.tan(camera_direction / 180 * np.pi + head_pitch + ball_pitch))
-                d_yaw = d_pitch / np.cos(ball_yaw)
-                # 投影到NAO坐标系
-                ball_x = d_yaw * np.cos(ball_yaw + head_yaw) + camera_x
-                ball_y = d_yaw * np.sin(ball_yaw + head_yaw) + camera_y
-                ball_yaw = np.arctan2(ball_y, ball_x)
-                self.golfBall.ballPosition["disX"] = ball_x
-                if stand_state == "standInit":
-                    ky = 42.513 * ball_x ** 4 - 109.66 * ball_x ** 3 + 104.2 * ball_x ** 2 - 44.218 * ball_x + 8.5526
-                    # ky = 12.604*ballX**4 - 37.962*ballX**3 + 43.163*ballX**2 - 22.688*ballX + 6.0526
-                    ball_y = ky * ball_y
-                    ball_yaw = np.arctan2(ball_y, ball_x)
-                self.golfBall.ballPosition["disY"] = ball_y
-                self.golfBall.ballPosition["angle"] = ball_yaw
+            ball_data = self.golfBall.ballData
+            ball_x, ball_y, ball_yaw = self.localise_circles([[ball_data["centerX"], ball_data["centerY"],
+                                                               ball_data["radius"]]], stand_state)
+            self.golfBall.ballPosition = {"disX": float(ball_x[0]), "disY": float(ball_y[0]),
+                                          "angle": float(ball_yaw[0])}
 
     def select_circle(self, circles):
         """
@@ -186,48 +404,154 @@ class GolfBallDetect(VisualBasis):
             selected circles
             :rtype: np.ndarray
         """
+        return self.__pick_circle(circles, self.__score_circles(circles))
+
+    def __score_circles(self, circles):
+        """
+        Score the circles by the red and green pixels in the 4r * 4r window around them.
+
+        :arg:
+            :param circles: numpy array shaped (N, 3),　N is the number of circles.
+            :type circles: np.ndarray
+        :return:
+            (rows of the circles whose window is inside the frame, deviation of their red ratio from the ideal,
+            inf for the ones failing the red / green thresholds)
+            :rtype: tuple
+        """
+        if not circles.shape or circles.shape[0] == 0:
+            return np.array([], np.intp), np.array([])
+
+        candidates = circles.reshape([-1, 3]).astype(np.int64)
+        centerX = candidates[:, 0]
+        centerY = candidates[:, 1]
+        radius = candidates[:, 2]
+        initX = centerX - 2 * radius
+        initY = centerY - 2 * radius
+        valid = ((initX >= 0) & (initY >= 0) & (initX + 4 * radius <= self.frameWidth) &
+                 (initY + 4 * radius <= self.frameHeight) & (radius >= 1))
+        if not valid.any():
+            return np.array([], np.intp), np.array([])
+        endX = np.minimum(initX + 4 * radius + 1, self.frameWidth)
+        endY = np.minimum(initY + 4 * radius + 1, self.frameHeight)
+
+        # Count red / green dominant pixels once for the region covering all the candidates,
+        # then the score of each candidate is four lookups in the integral images.
+        x0, y0 = initX[valid].min(), initY[valid].min()
+        x1, y1 = endX[valid].max(), endY[valid].max()
+        BGR_region = cv2.cvtColor(self.frame_view[y0:y1, x0:x1], cv2.COLOR_HSV2BGR)
+        b, g, r = cv2.split(BGR_region)
+        red_integral = cv2.integral(np.uint8((r > g) & (r > b)))
+        green_integral = cv2.integral(np.uint8(g > r))
+
+        top, left = initY[valid] - y0, initX[valid] - x0
+        bottom, right = endY[valid] - y0, endX[valid] - x0
+
+        def window_sum(integral):
+            return integral[bottom, right] - integral[top, right] - integral[bottom, left] + integral[top, left]
+
+        areas = 1.0 * (bottom - top) * (right - left)
+        rRatio = window_sum(red_integral) / areas
+        gRatio = window_sum(green_integral) / areas
+        deviation = np.where((rRatio >= 0.12) & (gRatio >= 0.2), np.abs(rRatio - BALL_RED_RATIO), np.inf)
+        return np.flatnonzero(valid), deviation
+
+    def __pick_circle(self, circles, scores):
+        """
+        Pick the winner of the scored circles.
+
+        :arg:
+            :param circles: numpy array shaped (N, 3),　N is the number of circles.
+            :type circles: np.ndarray
+            :param scores: result of __score_circles()
+            :type scores: tuple
+        :return:
+            selected circles
+            :rtype: np.ndarray
+        """
         # We do not find it useful so just pass
         if not circles.shape or circles.shape[0] == 0:
             return circles
 
         # return circles[0]
-        if circles.shape[0] == 1:
+        if self.__is_cut_circle(circles):
             print circles.shape
-            centerX = circles[0][0]
-            centerY = circles[0][1]
-            radius = circles[0][2]
-            initX = centerX - 2 * radius
-            initY = centerY - 2 * radius
-            if (initX < 0 or initY < 0 or (initX + 4 * radius) > self.frameWidth or
-                    (initY + 4 * radius) > self.frameHeight or radius < 1):
-                return circles
+            return circles
 
-        BGR_frame = cv2.cvtColor(self.frame_array, cv2.COLOR_HSV2BGR)
-        rRatioMin = 1.0
-        circleSelected = np.uint16([])
-        for circle in circles:
-            centerX = circle[0]
-            centerY = circle[1]
-            radius = circle[2]
-            initX = centerX - 2 * radius
-            initY = centerY - 2 * radius
-            if initX < 0 or initY < 0 or (initX + 4 * radius) > self.frameWidth or (
-                    initY + 4 * radius) > self.frameHeight or radius < 1:
-                continue
-            rectBallArea = BGR_frame[initY:initY + 4 * radius + 1, initX:initX + 4 * radius + 1, :]
-            bFlat = np.float16(rectBallArea[:, :, 0].flatten())
-            gFlat = np.float16(rectBallArea[:, :, 1].flatten())
-            rFlat = np.float16(rectBallArea[:, :, 2].flatten())
-            rScore1 = np.uint8(rFlat > 1.0 * gFlat)
-            rScore2 = np.uint8(rFlat > 1.0 * bFlat)
-            rScore = float(np.sum(rScore1 * rScore2))
-            gScore = float(np.sum(np.uint8(gFlat > 1 / 1.0 * rFlat)))
-            rRatio = rScore / len(rFlat)
-            gRatio = gScore / len(gFlat)
-            if rRatio >= 0.12 and gRatio >= 0.2 and abs(rRatio - 0.19) < abs(rRatioMin - 0.19):
-                circleSelected = circle
-                rRatioMin = rRatio
-        return circleSelected
+        rows, deviation = scores
+        if len(rows) == 0:
+            return np.uint16([])
+        # The ratio of red pixels closest to 0.19 wins, the first one on ties.
+        best = np.argmin(deviation)
+        if not deviation[best] < abs(1.0 - BALL_RED_RATIO):
+            return np.uint16([])
+        return circles.reshape([-1, 3])[rows[best]]
+
+    def __is_cut_circle(self, circles):
+        """
+        Whether there is a single circle and its 4r * 4r window leaves the frame, select_circle() takes such a
+        circle without scoring its colors.
+
+        :arg:
+            :param circles: numpy array shaped (N, 3),　N is the number of circles.
+            :type circles: np.ndarray
+        :return:
+            True means a single circle cut by the frame border
+            :rtype: bool
+        """
+        if not circles.shape or circles.shape[0] != 1:
+            return False
+        centerX, centerY, radius = [int(value) for value in circles.reshape([-1, 3])[0]]
+        initX = centerX - 2 * radius
+        initY = centerY - 2 * radius
+        return (initX < 0 or initY < 0 or (initX + 4 * radius) > self.frameWidth or
+                (initY + 4 * radius) > self.frameHeight or radius < 1)
+
+    def __rank_circles(self, circles, scores, stand_state):
+        """
+        Build the ranked candidates of a frame from the scored circles, best first.
+
+        The score is 1 for the ideal red ratio and falls to 0 where select_circle() rejects a circle,
+        the confidence also drops when the radius does not match the ball size expected at that distance.
+        A single circle cut by the frame border is taken by select_circle() unscored, it is ranked with score 0.
+
+        :arg:
+            :param circles: numpy array shaped (N, 3),　N is the number of circles.
+            :type circles: np.ndarray
+            :param scores: result of __score_circles()
+            :type scores: tuple
+            :param stand_state: Stand state of NAO robot, "standInit" or "standUp"
+            :type stand_state: str
+        :return:
+            candidates of BALL_CANDIDATE_DTYPE
+            :rtype: np.ndarray
+        """
+        rows, deviation = scores
+        max_deviation = abs(1.0 - BALL_RED_RATIO)
+        if self.__is_cut_circle(circles):
+            rows, deviation, kept = np.zeros(1, np.intp), np.array([max_deviation]), np.ones(1, bool)
+        else:
+            kept = deviation < max_deviation
+        if not kept.any():
+            return np.zeros(0, BALL_CANDIDATE_DTYPE)
+        # Stable sort, so the first candidate is the circle select_circle() picks.
+        order = np.argsort(deviation[kept], kind="mergesort")
+        rows, deviation = rows[kept][order], deviation[kept][order]
+        selected = circles.reshape([-1, 3])[rows].astype(np.int64)
+
+        candidates = np.zeros(len(rows), BALL_CANDIDATE_DTYPE)
+        candidates["centerX"] = selected[:, 0]
+        candidates["centerY"] = selected[:, 1]
+        candidates["radius"] = selected[:, 2]
+        candidates["score"] = 1.0 - deviation / max_deviation
+        candidates["confidence"] = candidates["score"]
+        if stand_state in BOTTOM_CAMERA_DIRECTION:
+            camera_position = self.camera_position("CameraBottom")
+            ball_x, ball_y, ball_yaw = self.localise_circles(selected, stand_state, camera_position)
+            candidates["disX"], candidates["disY"], candidates["angle"] = ball_x, ball_y, ball_yaw
+            expected_radius = self.__expected_radius(ball_x, ball_y, camera_position)
+            radius = np.maximum(selected[:, 2], 1)
+            candidates["confidence"] *= np.minimum(radius, expected_radius) / np.maximum(radius, expected_radius)
+        return candidates
 
     def update_ball_data(self, client="python-client", stand_state="standInit",
                          low_min_hsv=np.array([0, 43, 46]),
@@ -261,18 +585,200 @@ class GolfBallDetect(VisualBasis):
         min_radius = 3
         max_radius = int(self.frameHeight / 10.0)
 
-        self._gray_frame = self.__get_preprocessed_image(low_min_hsv, low_max_hsv, high_min_hsv, high_max_hsv)
-        circles = find_circles(self.gray_frame, min_dist, min_radius, max_radius)
-        circle = self.select_circle(circles)
+        # The stick ranges are included so that a stick detector reading the same frame reuses the labels.
+        color_table = get_color_table(((low_min_hsv, low_max_hsv), (high_min_hsv, high_max_hsv)), STICK_HSV_RANGES)
+
+        roi = self.__predict_roi(stand_state) if self.isTracking else None
+        if roi is not None:
+            x0, y0, x1, y1, radius = roi
+            self._gray_frame = self.__get_preprocessed_image(self.frame_labels(color_table, y0, y1, x0, x1),
+                                                             color_table)
+            circles = self.__detect_circles(self.gray_view, min_dist, max(min_radius, radius // 2),
+                                            min(max_radius, radius * 2), (x0, y0))
+        else:
+            # The ball lies on the ground, only its own size may show above the horizon.
+            top = self.ground_top_row(self.golfBall.ballRadius, max_radius + self.horizonMargin) \
+                if self.isHorizonCrop else 0
+            if top >= self.frameHeight - min_radius:
+                self._gray_frame = np.zeros((0, self.frameWidth), np.uint8)
+                circles = np.uint16([])
+            elif self.coarseScale > 1:
+                circles = self.__find_circles_coarse_to_fine(color_table, min_dist, min_radius, max_radius, top)
+            else:
+                self._gray_frame = self.__get_preprocessed_image(self.frame_labels(color_table, top), color_table)
+                circles = self.__detect_circles(self.gray_view, min_dist, min_radius, max_radius, (0, top),
+                                                stand_state)
+        with self._stage("select_circle"):
+            scores = self.__score_circles(circles)
+            circle = self.__pick_circle(circles, scores)
+        with self._stage("position"):
+            self.ballCandidates = self.__rank_circles(circles, scores, stand_state)
 
         if not circle.shape or circle.shape[0] == 0:
             # print "No ball detected"
             self.golfBall.ballData = {"centerX": 0, "centerY": 0, "radius": 0}
             self.golfBall.ballPosition = {"disX": 0, "disY": 0, "angle": 0}
+            self.missCount += 1
+            if roi is None or self.missCount >= self.maxMisses:
+                self.trackState = None
         else:
             circle = circle.reshape([-1, 3])
             self.golfBall.ballData = {"centerX": circle[0][0], "centerY": circle[0][1], "radius": circle[0][2]}
-            self._update_ball_position(stand_state)
+            best = self.ballCandidates[:1]
+            if stand_state in BOTTOM_CAMERA_DIRECTION:
+                # Already localised with the other candidates, the first one is this circle.
+                self.golfBall.ballPosition = {"disX": float(best["disX"][0]), "disY": float(best["disY"][0]),
+                                              "angle": float(best["angle"][0])}
+            else:
+                with self._stage("position"):
+                    self._update_ball_position(stand_state)
+            self.missCount = 0
+            if self.isTracking:
+                self.__remember_track()
+
+    def __remember_track(self):
+        """
+        Remember the detected ball and the odometry, used to predict where the ball is in the next frames.
+
+        :return: None
+        """
+        if not self.is_golf_ball_insight():
+            self.trackState = None
+            return
+        self.trackState = {"disX": self.golfBall.ballPosition["disX"],
+                           "disY": self.golfBall.ballPosition["disY"],
+                           "radius": int(self.golfBall.ballData["radius"]),
+                           "odometry": self.motionProxy.getRobotPosition(False)}
+
+    def __predict_roi(self, stand_state):
+        """
+        Predict the region of interest of the tracked ball from the head and odometry changes since it was found.
+
+        :arg:
+            :param stand_state: Stand state of NAO robot, "standInit" or "standUp"
+            :type stand_state: str
+        :return:
+            (x0, y0, x1, y1, radius) in pixels, None if the full frame should be searched
+            :rtype: tuple
+        """
+        track = self.trackState
+        if track is None or stand_state not in BOTTOM_CAMERA_DIRECTION:
+            return None
+
+        # Move the ball from the robot frame at detection into the current robot frame.
+        old_x, old_y, old_theta = track["odometry"]
+        new_x, new_y, new_theta = self.motionProxy.getRobotPosition(False)
+        world_x = old_x + track["disX"] * np.cos(old_theta) - track["disY"] * np.sin(old_theta)
+        world_y = old_y + track["disX"] * np.sin(old_theta) + track["disY"] * np.cos(old_theta)
+        ball_x = (world_x - new_x) * np.cos(new_theta) + (world_y - new_y) * np.sin(new_theta)
+        ball_y = -(world_x - new_x) * np.sin(new_theta) + (world_y - new_y) * np.cos(new_theta)
+
+        center = self.__project_ball(ball_x, ball_y, stand_state)
+        if center is None:
+            return None
+        center_x, center_y, scale = center
+        radius = max(3, int(round(track["radius"] * scale)))
+        # The prediction is rough, leave room for odometry drift besides the ball itself.
+        half_size = 3 * radius + 20
+        x0 = max(0, int(center_x) - half_size)
+        y0 = max(0, int(center_y) - half_size)
+        x1 = min(self.frameWidth, int(center_x) + half_size + 1)
+        y1 = min(self.frameHeight, int(center_y) + half_size + 1)
+        if x1 - x0 < 2 * radius or y1 - y0 < 2 * radius:
+            return None
+        return x0, y0, x1, y1, radius
+
+    def __project_ball(self, ball_x, ball_y, stand_state):
+        """
+        Project a ball position in the robot frame into the current frame, the inverse of _update_ball_position().
+
+        :arg:
+            :param ball_x: distance of the ball in x-axis
+            :type ball_x: float
+            :param ball_y: distance of the ball in y-axis
+            :type ball_y: float
+            :param stand_state: Stand state of NAO robot, "standInit" or "standUp"
+            :type stand_state: str
+        :return:
+            (centerX, centerY, radius scale against the tracked ball), None if it is out of the frame
+            :rtype: tuple
+        """
+        camera_position = self.camera_position("CameraBottom")
+        head_angles = self.head_angles()
+        camera_x, camera_y = camera_position[:2]
+        center = ground_to_pixel(ball_x, ball_y, (self.frameWidth, self.frameHeight),
+                                 (self.cameraYawRange, self.cameraPitchRange), camera_position, head_angles,
+                                 stand_state, self.golfBall.ballRadius)
+        if center is None:
+            return None
+        track = self.trackState
+        scale = (np.hypot(track["disX"] - camera_x, track["disY"] - camera_y) /
+                 max(np.hypot(ball_x - camera_x, ball_y - camera_y), 1e-3))
+        return center[0], center[1], scale
+
+    def __find_circles_coarse_to_fine(self, color_table, min_dist, min_radius, max_radius, top=0):
+        """
+        Find candidate blobs in a downscaled frame, then detect circles only in small full resolution windows
+        around them.
+
+        :arg:
+            :param color_table: color table of the thresholds
+            :type color_table: ColorTable
+            :param min_dist: minium distance between the center of two circle in full resolution
+            :type min_dist: float
+            :param min_radius: minium radius of circles in full resolution
+            :type min_radius: float
+            :param max_radius: maximum radius of circles in full resolution
+            :type max_radius: float
+            :param top: first row of the frame searched
+            :type top: int
+        :return:
+            an uint16 numpy array shaped circleNum * 3 in full resolution coordinates
+            :rtype: np.ndarray
+        """
+        scale = self.coarseScale
+        # Nearest neighbour keeps the hue values unmixed, averaging would break the red hue wrapping around 0.
+        with self._stage("classify"):
+            coarse_size = (self.frameWidth // scale, (self.frameHeight - top) // scale)
+            coarse_frame = cv2.resize(self.frame_view[top:], coarse_size, interpolation=cv2.INTER_NEAREST,
+                                      dst=self.pipeline.buffer("coarse", (coarse_size[1], coarse_size[0],
+                                                                          self.frameChannels)))
+            coarse_labels = self.pipeline.classify(color_table, coarse_frame)
+        coarse_mask = self.__get_preprocessed_image(coarse_labels, color_table)
+        # The windows below are preprocessed into the same pipeline buffers, keep the coarse mask apart.
+        self._gray_frame = self.pipeline.buffer("coarse_mask", coarse_mask.shape)
+        np.copyto(self._gray_frame, coarse_mask)
+        # Hough misses balls only a few pixels wide in the coarse frame, their blobs are still there.
+        with self._stage("circles"):
+            _, _, stats, _ = cv2.connectedComponentsWithStats(self._gray_frame)
+        stats = stats[1:]
+        sizes = np.maximum(stats[:, cv2.CC_STAT_WIDTH], stats[:, cv2.CC_STAT_HEIGHT]) * scale
+        stats = stats[(sizes >= 2 * min_radius - 2 * scale) & (sizes <= 2 * max_radius + 2 * scale)]
+        # Blobs looking most like a disc are refined first: square bounding box filled by about pi / 4.
+        widths = stats[:, cv2.CC_STAT_WIDTH].astype(np.float32)
+        heights = stats[:, cv2.CC_STAT_HEIGHT].astype(np.float32)
+        fill = stats[:, cv2.CC_STAT_AREA] / (widths * heights)
+        roundness = np.abs(1 - widths / heights) + np.abs(fill - np.pi / 4)
+        stats = stats[np.argsort(roundness)][:self.maxRefinedCandidates]
+
+        refined = []
+        for x, y, w, h, _ in stats * scale:
+            y += top
+            radius = max(w, h) // 2
+            # Leave room for the morphology and blur kernels around the blob.
+            margin = radius + 8
+            x0 = max(0, x - margin)
+            y0 = max(0, y - margin)
+            x1 = min(self.frameWidth, x + w + margin)
+            y1 = min(self.frameHeight, y + h + margin)
+            window = self.__get_preprocessed_image(self.frame_labels(color_table, y0, y1, x0, x1), color_table)
+            circles = self.__detect_circles(window, min_dist, max(min_radius, radius - 2 * scale),
+                                            min(max_radius, radius + 2 * scale), (x0, y0))
+            for circle in circles.tolist():
+                # Windows of close candidates overlap, keep one circle for each place.
+                if all(abs(circle[0] - other[0]) + abs(circle[1] - other[1]) > min_dist for other in refined):
+                    refined.append(circle)
+        return np.uint16(refined)
 
     @property
     def ball_position(self):
@@ -300,6 +806,19 @@ class GolfBallDetect(VisualBasis):
                 self.golfBall.ballData['centerY'],
                 self.golfBall.ballData['radius']]
 
+    @property
+    def ball_candidates(self):
+        """
+        Get all the ball candidates of the current frame, ranked best first. The first one is the ball of
+        ball_data, the others let the caller fall back without detecting again when the first is rejected.
+
+        :return:
+            structured array of BALL_CANDIDATE_DTYPE: centerX, centerY, radius, score, disX, disY, angle
+            and confidence
+            :rtype: np.ndarray
+        """
+        return self.ballCandidates
+
     def show_ball_position(self):
         """
         Show ball data in the current frame.
@@ -311,7 +830,7 @@ class GolfBallDetect(VisualBasis):
               ", " + str(self.golfBall.ballPosition["disY"]) + ")"
         print "ball radius = " + str(self.golfBall.ballData["radius"])
         if self.golfBall.ballData["radius"] == 0:
-            cv2.imshow("Ball Position", cv2.cvtColor(self.frame_array, cv2.COLOR_HSV2BGR_FULL))
+            cv2.imshow("Ball Position", cv2.cvtColor(self.frame_view, cv2.COLOR_HSV2BGR_FULL))
         else:
             # print "ballX = " + str(self.ballData["centerX"])
             # print "ballY = " + str(self.ballData["centerY"])
@@ -359,7 +878,7 @@ class GolfBallDetect(VisualBasis):
                                   low_max_hsv=max_hsv1,
                                   high_min_hsv=min_hsv2,
                                   high_max_hsv=max_hsv2)
-            cv2.imshow(window_name, cv2.cvtColor(self.frame_array, cv2.COLOR_HSV2BGR_FULL))
+            cv2.imshow(window_name, cv2.cvtColor(self.frame_view, cv2.COLOR_HSV2BGR_FULL))
             self.show_gray_frame()
             self.show_ball_position()
             k = cv2.waitKey(10) & 0xFF
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2023/12/13 16:48
+@Author  : Evan Wong
+@File    : ground_projection.py
+@Project : NAOGolf
+@Description: Vectorized pixel to ground projection of the bottom camera, cached per head pose, and the horizon
+"""
+
+import collections
+
+import numpy as np
+
+# Initial pitch of the bottom camera in degree for each stand state
+BOTTOM_CAMERA_DIRECTION = {"standInit": 49.2, "standUp": 39.7}
+
+
+def lateral_scale(ball_x):
+    """
+    Empirical correction of the lateral distance in "standInit" state, measured disY = lateral_scale(disX) * disY.
+
+    :arg:
+        :param ball_x: distance of the ball in x-axis
+        :type ball_x: float | np.ndarray
+    :return:
+        the scale of the lateral distance
+        :rtype: float | np.ndarray
+    """
+    return 42.513 * ball_x ** 4 - 109.66 * ball_x ** 3 + 104.2 * ball_x ** 2 - 44.218 * ball_x + 8.5526
+    # return 12.604*ballX**4 - 37.962*ballX**3 + 43.163*ballX**2 - 22.688*ballX + 6.0526
+
+
+def pixel_to_ground(center_x, center_y, frame_size, view_range, camera_position, head_angles, stand_state,
+                    ball_radius):
+    """
+    Project pixels of the bottom camera to ball positions on the ground, in the robot frame.
+
+    :arg:
+        :param center_x: x coordinates of the pixels
+        :type center_x: np.ndarray
+        :param center_y: y coordinates of the pixels
+        :type center_y: np.ndarray
+        :param frame_size: (frameWidth, frameHeight)
+        :type frame_size: tuple
+        :param view_range: (cameraYawRange, cameraPitchRange) in rad
+        :type view_range: tuple
+        :param camera_position: position of the camera in FRAME_ROBOT, [x, y, z, ...]
+        :type camera_position: list
+        :param head_angles: (HeadYaw, HeadPitch) in rad
+        :type head_angles: tuple
+        :param stand_state: Stand state of NAO robot, "standInit" or "standUp"
+        :type stand_state: str
+        :param ball_radius: radius of the ball in meter
+        :type ball_radius: float
+    :return:
+        (disX, disY, angle) arrays shaped like the pixels
+        :rtype: tuple
+    :raise: KeyError
+    """
+    frame_width, frame_height = frame_size
+    yaw_range, pitch_range = view_range
+    camera_x, camera_y, camera_height = camera_position[:3]
+    head_yaw, head_pitch = head_angles
+    camera_direction = BOTTOM_CAMERA_DIRECTION[stand_state]
+
+    # 像素坐标系 -> 图片坐标系 -> 相机坐标系（angle）
+    ball_pitch = (np.asarray(center_y, np.float64) - 1.0 * frame_height / 2) * pitch_range / frame_height
+    ball_yaw = (1.0 * frame_width / 2 - np.asarray(center_x, np.float64)) * yaw_range / frame_width
+    d_pitch = (camera_height - ball_radius) / np.tan(camera_direction / 180 * np.pi + head_pitch + ball_pitch)
+    d_yaw = d_pitch / np.cos(ball_yaw)
+    # 投影到NAO坐标系
+    ball_x = d_yaw * np.cos(ball_yaw + head_yaw) + camera_x
+    ball_y = d_yaw * np.sin(ball_yaw + head_yaw) + camera_y
+    if stand_state == "standInit":
+        ball_y = lateral_scale(ball_x) * ball_y
+    return ball_x, ball_y, np.arctan2(ball_y, ball_x)
+
+
+def ground_to_pixel(ball_x, ball_y, frame_size, view_range, camera_position, head_angles, stand_state,
+                    ball_radius):
+    """
+    Project a ball position in the robot frame into the bottom camera, the inverse of pixel_to_ground().
+
+    :arg:
+        :param ball_x: distance of the ball in x-axis
+        :type ball_x: float
+        :param ball_y: distance of the ball in y-axis
+        :type ball_y: float
+        :param frame_size: (frameWidth, frameHeight)
+        :type frame_size: tuple
+        :param view_range: (cameraYawRange, cameraPitchRange) in rad
+        :type view_range: tuple
+        :param camera_position: position of the camera in FRAME_ROBOT, [x, y, z, ...]
+        :type camera_position: list
+        :param head_angles: (HeadYaw, HeadPitch) in rad
+        :type head_angles: tuple
+        :param stand_state: Stand state of NAO robot, "standInit" or "standUp"
+        :type stand_state: str
+        :param ball_radius: radius of the ball in meter
+        :type ball_radius: float
+    :return:
+        (centerX, centerY), None if the ball is behind the camera or out of the frame
+        :rtype: tuple
+    :raise: KeyError
+    """
+    frame_width, frame_height = frame_size
+    yaw_range, pitch_range = view_range
+    camera_x, camera_y, camera_height = camera_position[:3]
+    head_yaw, head_pitch = head_angles
+    camera_direction = BOTTOM_CAMERA_DIRECTION[stand_state]
+
+    if stand_state == "standInit":
+        ky = lateral_scale(ball_x)
+        if abs(ky) < 1e-3:
+            return None
+        ball_y = ball_y / ky
+    d_x = ball_x - camera_x
+    d_y = ball_y - camera_y
+    d_yaw = np.hypot(d_x, d_y)
+    ball_yaw = np.arctan2(d_y, d_x) - head_yaw
+    d_pitch = d_yaw * np.cos(ball_yaw)
+    if d_pitch <= 0:
+        return None
+    ball_pitch = np.arctan2(camera_height - ball_radius, d_pitch) - camera_direction / 180 * np.pi - head_pitch
+    center_x = 1.0 * frame_width / 2 - ball_yaw * frame_width / yaw_range
+    center_y = 1.0 * frame_height / 2 + ball_pitch * frame_height / pitch_range
+    if not (0 <= center_x < frame_width and 0 <= center_y < frame_height):
+        return None
+    return center_x, center_y
+
+
+def horizon_row(frame_size, view_range, camera_position):
+    """
+    Highest row of the horizon seen by a camera, objects on the ground lower than the camera only appear below it.
+
+    :arg:
+        :param frame_size: (frameWidth, frameHeight)
+        :type frame_size: tuple
+        :param view_range: (cameraYawRange, cameraPitchRange) in rad
+        :type view_range: tuple
+        :param camera_position: position of the camera in FRAME_ROBOT, [x, y, z, wx, wy, wz]
+        :type camera_position: list
+    :return:
+        the row, negative when the horizon is above the frame, frameHeight or more when below it
+        :rtype: float
+    """
+    frame_width, frame_height = frame_size
+    yaw_range, pitch_range = view_range
+    camera_roll, camera_pitch = camera_position[3:5]
+    # A rolled camera sees a tilted horizon, its end at the frame border is the highest.
+    tilt = abs(np.tan(camera_roll)) * frame_width / 2 * (frame_height / pitch_range) / (frame_width / yaw_range)
+    return 1.0 * frame_height / 2 - camera_pitch * frame_height / pitch_range - tilt
+
+
+class GroundProjectionTable(object):
+    """
+    Pixel to ground lookup tables keyed by stand state, camera height and quantized head pitch / yaw,
+    the least recently used table is dropped when the cache is full.
+    """
+
+    def __init__(self, frame_size, view_range, ball_radius, angle_step=0.005, height_step=0.005, max_tables=8,
+                 max_misses=64):
+        """
+        Initialization.
+
+        :arg:
+            :param frame_size: (frameWidth, frameHeight)
+            :type frame_size: tuple
+            :param view_range: (cameraYawRange, cameraPitchRange) in rad
+            :type view_range: tuple
+            :param ball_radius: radius of the ball in meter
+            :type ball_radius: float
+            :param angle_step: quantization step of the head angles in rad
+            :type angle_step: float
+            :param height_step: quantization step of the camera height in meter
+            :type height_step: float
+            :param max_tables: how many tables are cached, a VGA table takes 3.7 MB
+            :type max_tables: int
+            :param max_misses: how many poses seen once are remembered, the oldest one is forgotten beyond
+            :type max_misses: int
+        :return: None
+        """
+        self.frameSize = tuple(frame_size)
+        self.viewRange = tuple(view_range)
+        self.ballRadius = ball_radius
+        self.angleStep = angle_step
+        self.heightStep = height_step
+        self.maxTables = max_tables
+        self._tables = collections.OrderedDict()
+        self.maxMisses = max_misses
+        self._misses = collections.OrderedDict()
+
+    def _quantize(self, camera_position, head_angles, stand_state):
+        """
+        Get the key of a head pose and the pose the key stands for.
+
+        :return:
+            (key, quantized camera position, quantized head angles)
+            :rtype: tuple
+        """
+        yaw_index = int(round(head_angles[0] / self.angleStep))
+        pitch_index = int(round(head_angles[1] / self.angleStep))
+        height_index = int(round(camera_position[2] / self.heightStep))
+        key = (stand_state, height_index, pitch_index, yaw_index)
+        # The camera x / y move with the head yaw, keep the ones of the first query.
+        position = [camera_position[0], camera_position[1], height_index * self.heightStep]
+        return key, position, (yaw_index * self.angleStep, pitch_index * self.angleStep)
+
+    def localise(self, center_x, center_y, camera_position, head_angles, stand_state):
+        """
+        Project any number of pixels to ball positions on the ground.
+
+        A head pose seen for the first time only projects the given pixels, the whole table is built the
+        second time the pose comes, so a moving head does not pay for tables it never uses again.
+
+        :arg:
+            :param center_x: x coordinates of the pixels
+            :type center_x: np.ndarray
+            :param center_y: y coordinates of the pixels
+            :type center_y: np.ndarray
+            :param camera_position: position of the bottom camera in FRAME_ROBOT, [x, y, z, ...]
+            :type camera_position: list
+            :param head_angles: (HeadYaw, HeadPitch) in rad
+            :type head_angles: tuple
+            :param stand_state: Stand state of NAO robot, "standInit" or "standUp"
+            :type stand_state: str
+        :return:
+            (disX, disY, angle) arrays shaped like the pixels
+            :rtype: tuple
+        :raise: KeyError
+        """
+        key, position, angles = self._quantize(camera_position, head_angles, stand_state)
+        table = self._tables.pop(key, None)
+        if table is None:
+            if key not in self._misses:
+                if len(self._misses) >= self.maxMisses:
+                    self._misses.popitem(last=False)
+                self._misses[key] = position
+                return pixel_to_ground(center_x, center_y, self.frameSize, self.viewRange, position, angles,
+                                       stand_state, self.ballRadius)
+            table = self._build(self._misses.pop(key), angles, stand_state)
+            if len(self._tables) >= self.maxTables:
+                self._tables.popitem(last=False)
+        self._tables[key] = table
+
+        center_x = np.clip(np.asarray(center_x, np.intp), 0, self.frameSize[0] - 1)
+        center_y = np.clip(np.asarray(center_y, np.intp), 0, self.frameSize[1] - 1)
+        ball_x, ball_y, angle = table
+        return ball_x[center_y, center_x], ball_y[center_y, center_x], angle[center_y, center_x]
+
+    def localise_mask(self, mask, camera_position, head_angles, stand_state):
+        """
+        Project every non-zero pixel of a binary image to the ground.
+
+        :arg:
+            :param mask: binary image of the whole frame
+            :type mask: np.ndarray
+            :param camera_position: position of the bottom camera in FRAME_ROBOT, [x, y, z, ...]
+            :type camera_position: list
+            :param head_angles: (HeadYaw, HeadPitch) in rad
+            :type head_angles: tuple
+            :param stand_state: Stand state of NAO robot, "standInit" or "standUp"
+            :type stand_state: str
+        :return:
+            (disX, disY, angle) arrays of the non-zero pixels
+            :rtype: tuple
+        """
+        center_y, center_x = np.nonzero(mask)
+        return self.localise(center_x, center_y, camera_position, head_angles, stand_state)
+
+    def _build(self, camera_position, head_angles, stand_state):
+        """
+        Build the table of one head pose.
+
+        :return:
+            (disX, disY, angle) float32 arrays shaped frameHeight * frameWidth
+            :rtype: tuple
+        """
+        frame_width, frame_height = self.frameSize
+        center_y, center_x = np.mgrid[0:frame_height, 0:frame_width]
+        return tuple(np.float32(values) for values in
+                     pixel_to_ground(center_x, center_y, self.frameSize, self.viewRange, camera_position,
+                                     head_angles, stand_state, self.ballRadius))
@@ -9,12 +9,60 @@
 
 import time
 
-import math
-import almath
 import numpy as np
 import vision_definitions as vd
 
 from visual_basis import VisualBasis
+from pose_snapshot import transform_from_6d
+
+
+def mark_angles(mark_data):
+    """
+    Get the angles of every mark in a "LandmarkDetected" value.
+
+    :arg:
+        :param mark_data: value of "LandmarkDetected"
+        :type mark_data: list
+    :return:
+        N * 3 array of [alpha, beta, sizeX] in rad
+        :rtype: np.ndarray
+    """
+    # MarkInfo = [ShapeInfo, MarkID], ShapeInfo = [1, alpha, beta, sizeX, sizeY, heading]
+    return np.array([mark_info[0][1:4] for mark_info in mark_data[1]], np.float64).reshape(-1, 3)
+
+
+def landmark_positions(marks, camera_transform, landmark_size):
+    """
+    Compute the positions in the robot frame of all the marks seen in one frame, the vectorized form of
+    robotToCamera * Transform_from3DRotation(0, beta, alpha) * Transform(distance, 0, 0) of almath.
+
+    :arg:
+        :param marks: N * 3 array of [alpha, beta, sizeX] in rad, further columns are ignored
+        :type marks: np.ndarray
+        :param camera_transform: transform of the camera in FRAME_ROBOT, 16 values row major or 4 * 4
+        :type camera_transform: list
+        :param landmark_size: size of NAO landmark in meter
+        :type landmark_size: float
+    :return:
+        N * 4 array of [disX, disY, dist, yawAngle]
+        :rtype: np.ndarray
+    """
+    marks = np.asarray(marks, np.float64).reshape(len(marks), -1)
+    alpha, beta, angular_size = marks[:, 0], marks[:, 1], marks[:, 2]
+    # tan(angularSize / 2) = (landmark_size / 2) / distance
+    distance = landmark_size / (2 * np.tan(angular_size / 2))
+    # Rz(alpha) * Ry(beta) * [distance, 0, 0], the mark in the camera frame
+    points = np.empty((len(marks), 3))
+    points[:, 0] = distance * np.cos(beta) * np.cos(alpha)
+    points[:, 1] = distance * np.cos(beta) * np.sin(alpha)
+    points[:, 2] = -distance * np.sin(beta)
+    transform = np.asarray(camera_transform, np.float64).reshape(4, 4)
+    positions = np.empty((len(marks), 4))
+    # Only x and y in the robot frame are needed.
+    positions[:, :2] = points.dot(transform[:2, :3].T) + transform[:2, 3]
+    positions[:, 2] = np.hypot(positions[:, 0], positions[:, 1])
+    positions[:, 3] = np.arctan2(positions[:, 0], positions[:, 1])
+    return positions
 
 
 class LandMarkDetect(VisualBasis):
@@ -42,6 +90,13 @@ class LandMarkDetect(VisualBasis):
             self.dist = 0
             self.yawAngle = 0
             self.mark_info = []
+            # [alpha, beta, sizeX] of all the marks in the frame, mark_info is about the first one
+            self.marks = np.zeros((0, 3))
+            self.mark_ids = []
+            # [disX, disY, dist, yawAngle] of every mark
+            self.positions = np.zeros((0, 4))
+            # 6D position of the camera when the mark was seen, None to use the current one
+            self.camera_pose = None
 
     def __init__(self, ip, port=9559, camera_id=vd.kTopCamera, landmark_size=0.105):
         """
@@ -61,8 +116,20 @@ class LandMarkDetect(VisualBasis):
         super(LandMarkDetect, self).__init__(ip, port, camera_id)
         self.landmark = self.Landmark(landmark_size)
         self.cameraID = camera_id
-        self.cameraName = "CameraTop" if camera_id == vd.kTopCamera else "CameraBottom"
-        self.cameraProxy.setActiveCamera(self.cameraID)
+        self.landmarkService = None
+        if self.cameraProxy is not None:
+            self.cameraProxy.setActiveCamera(self.cameraID)
+
+    def attach_landmark_service(self, service):
+        """
+        Search the landmark with a LandmarkService, which gets the marks by event during one head sweep.
+
+        :arg:
+            :param service: the started service, None to poll ALMemory again
+            :type service: LandmarkService
+        :return: None
+        """
+        self.landmarkService = service
 
     def update_landmark_data(self):
         """
@@ -70,6 +137,8 @@ class LandMarkDetect(VisualBasis):
 
         :return: None
         """
+        # ALLandMarkDetection works on the active camera. Frames are grabbed without switching it any more,
+        # so this only waits when some other module has changed the active camera.
         if self.cameraProxy.getActiveCamera() != self.cameraID:
             self.cameraProxy.setActiveCamera(self.cameraID)
             time.sleep(1)
@@ -82,22 +151,8 @@ class LandMarkDetect(VisualBasis):
             self.landmark.dist = 0
             self.landmark.yawAngle = 0
         else:
-            wzCamera = self.landmark.mark_info[0]  # alpha
-            wyCamera = self.landmark.mark_info[1]  # beta
-            angularSize = self.landmark.mark_info[2]  # sizeX
-            distCameraToLandmark = self.landmark.landmark_size / (2 * math.tan(angularSize / 2))
-            # 变形而来，原式为：
-            # tan(angularSize / 2) = (self.landmark.landmark_size / 2) / distCameraToLandmark
-            transform = self.motionProxy.getTransform(self.cameraName, 2, True)  # 2 means FRAME_ROBOT
-            transformList = almath.vectorFloat(transform)
-            robotToCamera = almath.Transform(transformList)
-            cameraToLandmarkRotTrans = almath.Transform_from3DRotation(0, wyCamera, wzCamera)
-            cameraToLandmarkTranslationTrans = almath.Transform(distCameraToLandmark, 0, 0)
-            robotToLandmark = robotToCamera * cameraToLandmarkRotTrans * cameraToLandmarkTranslationTrans
-            self.landmark.dis_x = robotToLandmark.r1_c4
-            self.landmark.dis_y = robotToLandmark.r2_c4
-            self.landmark.dist = np.sqrt(self.landmark.dis_x ** 2 + self.landmark.dis_y ** 2)
-            self.landmark.yawAngle = math.atan2(self.landmark.dis_x, self.landmark.dis_y)
+            with self._stage("landmark_geometry"):
+                self._update_landmark_position()
 
         """
         这段代码的主要目的是更新NAO机器人的地标信息。它首先检查当前活动的相机是否是预设的相机，如果不是，就将预设的相机设置为活动相机。
@@ -121,6 +176,22 @@ class LandMarkDetect(VisualBasis):
         从这个矩阵中，可以提取出地标在机器人坐标系中的x和y坐标（`dis_x`, `dis_y`），以及地标到机器人的距离（`dist`）和偏航角（`yawAngle`）。
         """
 
+    def _update_landmark_position(self):
+        """
+        Compute the positions in the robot frame of all the marks from their angles in the camera,
+        the landmark is the first mark.
+
+        :return: None
+        """
+        if self.landmark.camera_pose is not None:
+            # The head keeps moving during a sweep, so the camera is placed where the mark was seen.
+            transform = transform_from_6d(self.landmark.camera_pose).flatten().tolist()
+        else:
+            transform = self.camera_transform()
+        self.landmark.positions = landmark_positions(self.landmark.marks, transform, self.landmark.landmark_size)
+        self.landmark.dis_x, self.landmark.dis_y, self.landmark.dist, self.landmark.yawAngle = \
+            [float(value) for value in self.landmark.positions[0]]
+
     def get_landmark_data(self):
         """
         Get landmark information.
@@ -146,49 +217,86 @@ class LandMarkDetect(VisualBasis):
 
         :return: None
         """
+        if self.landmarkService is not None:
+            markData = self.landmarkService.search()
+            if markData:
+                print "I saw landmark!"
+                # CameraPoseInFrameRobot of the frame the mark was seen in, its yaw is the one of the head then.
+                self.__set_mark(markData, markData[3][5], markData[3])
+            else:
+                self.__set_no_mark()
+            return
+
         headYawAngle = -2
 
         self.motionProxy.angleInterpolationWithSpeed("HeadPitch", 0.0, 0.3)
         self.motionProxy.angleInterpolationWithSpeed("HeadYaw", 0.0, 0.3)
         self.landmarkProxy.subscribe("landmarkTest")
-        while headYawAngle <= 2:
-            self.motionProxy.angleInterpolationWithSpeed("HeadYaw", headYawAngle, 0.1)
-            time.sleep(1)
-            markData = self.memoryProxy.getData("LandmarkDetected")
+        try:
+            while headYawAngle <= 2:
+                self.motionProxy.angleInterpolationWithSpeed("HeadYaw", headYawAngle, 0.1)
+                time.sleep(1)
+                markData = self.memoryProxy.getData("LandmarkDetected")
+
+                if markData and isinstance(markData, list) and len(markData) >= 2:
+                    # self.ttsProxy.post.say("i saw landmark!")
+                    print "I saw landmark!"
+                    self.__set_mark(markData, self.head_angles()[0])
+                    return
+                else:
+                    # self.ttsProxy.post.say("where is landmark ?")
+                    print "where is landmark ?"
+                    headYawAngle = headYawAngle + 0.8
+            self.__set_no_mark()
+        finally:
+            self.landmarkProxy.unsubscribe("landmarkTest")
+
+    def __set_mark(self, markData, head_yaw_angle, camera_pose=None):
+        """
+        Keep the angles of the marks in the "LandmarkDetected" data.
 
-            if markData and isinstance(markData, list) and len(markData) >= 2:
-                # self.ttsProxy.post.say("i saw landmark!")
-                print "I saw landmark!"
-                self.landmark.landmark_flag = True
-                # mark_data:
-                #   [TimeStampField, MarkInfo[N], CameraPoseInFrameTorso, CameraPoseInFrameRobot, CurrentCameraName]
-                #       - MarkInfo = [ShapeInfo, MarkID]
-                #           - ShapeInfo = [1, alpha, beta, sizeX, sizeY, heading]
-                #               - `alpha` and `beta` represent the location of the NaoMark’s center
-                #                 in terms of camera angles in radian.
-                #               - `sizeX` and `sizeY` are the mark’s size in camera angles.
-                #               - the `heading` angle describes how the Nao mark is oriented about the vertical axis
-                #                 in regard to the robot’s head.
-                wzCamera = markData[1][0][0][1]
-                wyCamera = markData[1][0][0][2]
-                angularSize = markData[1][0][0][3]
-
-                head_yaw_angle = self.motionProxy.getAngles("HeadYaw", True)
-
-                head_angle = wzCamera + head_yaw_angle[0]
-                self.landmark.mark_info = [wzCamera, wyCamera, angularSize, head_angle]
-                return
-            else:
-                # self.ttsProxy.post.say("where is landmark ?")
-                print "where is landmark ?"
-                headYawAngle = headYawAngle + 0.8
+        :arg:
+            :param markData: value of "LandmarkDetected"
+            :type markData: list
+            :param head_yaw_angle: HeadYaw when the mark was seen
+            :type head_yaw_angle: float
+            :param camera_pose: 6D position of the camera when the mark was seen, None to use the current one
+            :type camera_pose: list
+        :return: None
+        """
+        self.landmark.landmark_flag = True
+        # mark_data:
+        #   [TimeStampField, MarkInfo[N], CameraPoseInFrameTorso, CameraPoseInFrameRobot, CurrentCameraName]
+        #       - MarkInfo = [ShapeInfo, MarkID]
+        #           - ShapeInfo = [1, alpha, beta, sizeX, sizeY, heading]
+        #               - `alpha` and `beta` represent the location of the NaoMark’s center
+        #                 in terms of camera angles in radian.
+        #               - `sizeX` and `sizeY` are the mark’s size in camera angles.
+        #               - the `heading` angle describes how the Nao mark is oriented about the vertical axis
+        #                 in regard to the robot’s head.
+        self.landmark.marks = mark_angles(markData)
+        self.landmark.mark_ids = [markInfo[1][0] for markInfo in markData[1]]
+        wzCamera, wyCamera, angularSize = [float(value) for value in self.landmark.marks[0]]
+
+        head_angle = wzCamera + head_yaw_angle
+        self.landmark.mark_info = [wzCamera, wyCamera, angularSize, head_angle]
+        self.landmark.camera_pose = camera_pose
+
+    def __set_no_mark(self):
+        """
+        Record that no landmark was found.
+
+        :return: None
+        """
         # self.ttsProxy.post.say("I can not find landmark ! I will hit the ball directly ! ")
         print "I can not find landmark ! I will hit the ball directly ! "
         print "landmark is not in sight !"
         self.landmark.landmark_flag = False
         self.landmark.mark_info = [0.0, 0.0, 0.0, 0.0]
-
-        self.landmarkProxy.unsubscribe("landmarkTest")
+        self.landmark.marks = np.zeros((0, 3))
+        self.landmark.mark_ids = []
+        self.landmark.positions = np.zeros((0, 4))
+        self.landmark.camera_pose = None
 
     def is_landmark_insight(self):
         """
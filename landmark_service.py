@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2023/12/19 15:20
+@Author  : Evan Wong
+@File    : landmark_service.py
+@Project : NAOGolf
+@Description: Landmark detection kept subscribed and read by event, with a continuous head sweep
+"""
+
+import sys
+import time
+import threading
+
+from naoqi import ALProxy, ALModule, ALBroker
+
+
+class LandmarkService(ALModule):
+    """
+    A NAOqi module which keeps ALLandMarkDetection subscribed and gets "LandmarkDetected" by an event callback,
+    so that a search sweeps the head in one continuous motion and stops as soon as a mark is raised.
+
+    The callbacks need a local broker connected to the robot, so one is created for each service.
+    """
+
+    def __init__(self, ip, port=9559, name="LandmarkService", period=100, sweep_speed=0.15):
+        """
+        Initialization.
+
+        :arg:
+            :param ip: the ip address of a NAO robot
+            :type ip: str
+            :param port: the port to connect NAO robot (9559, default)
+            :type port: int
+            :param name: name of the module, unique on the broker
+            :type name: str
+            :param period: period of ALLandMarkDetection in ms
+            :type period: int
+            :param sweep_speed: fraction of the maximum head speed while sweeping
+            :type sweep_speed: float
+        :return: None
+        """
+        # 0.0.0.0 and port 0 let the broker listen on any interface and a free port.
+        self.broker = ALBroker(name + "Broker", "0.0.0.0", 0, ip, port)
+        ALModule.__init__(self, name)
+        # NAOqi finds the module of a callback by its name in the main module.
+        setattr(sys.modules["__main__"], name, self)
+        self.name = name
+        self.period = period
+        self.sweepSpeed = sweep_speed
+        self.memoryProxy = ALProxy("ALMemory", ip, port)
+        self.motionProxy = ALProxy("ALMotion", ip, port)
+        self.landmarkProxy = ALProxy("ALLandMarkDetection", ip, port)
+        self.markData = None
+        self.markTime = 0.0
+        self._lock = threading.Lock()
+        self._found = threading.Event()
+        self._subscribed = False
+
+    def start(self):
+        """
+        Subscribe ALLandMarkDetection and the "LandmarkDetected" event.
+
+        :return: None
+        """
+        if self._subscribed:
+            return
+        self.landmarkProxy.subscribe(self.name, self.period, 0.0)
+        try:
+            self.memoryProxy.subscribeToEvent("LandmarkDetected", self.name, "on_landmark_detected")
+        except RuntimeError:
+            self.landmarkProxy.unsubscribe(self.name)
+            raise
+        self._subscribed = True
+
+    def stop(self):
+        """
+        Unsubscribe the event and ALLandMarkDetection, the detection stops using the CPU.
+
+        :return: None
+        """
+        if not self._subscribed:
+            return
+        self._subscribed = False
+        try:
+            self.memoryProxy.unsubscribeToEvent("LandmarkDetected", self.name)
+        finally:
+            self.landmarkProxy.unsubscribe(self.name)
+
+    def close(self):
+        """
+        Stop the service and shut its broker down.
+
+        :return: None
+        """
+        try:
+            self.stop()
+        finally:
+            self.broker.shutdown()
+
+    @property
+    def is_subscribed(self):
+        """
+        Whether the detection is subscribed.
+
+        :return:
+            True means subscribed
+            :rtype: bool
+        """
+        return self._subscribed
+
+    def on_landmark_detected(self, key, value, message):
+        """
+        Callback of "LandmarkDetected", the event is raised with an empty value when the marks are lost.
+        """
+        if not value or len(value) < 2 or not value[1]:
+            return
+        with self._lock:
+            self.markData = value
+            self.markTime = time.time()
+            self._found.set()
+
+    def latest(self, max_age):
+        """
+        Get the last mark data if it was raised recently.
+
+        :arg:
+            :param max_age: largest age of the data in seconds
+            :type max_age: float
+        :return:
+            the "LandmarkDetected" value, None if there is none that recent
+            :rtype: list
+        """
+        with self._lock:
+            if self.markData is not None and time.time() - self.markTime <= max_age:
+                return self.markData
+        return None
+
+    def search(self, min_yaw=-2.0, max_yaw=2.0, head_pitch=0.0, max_age=0.0):
+        """
+        Sweep the head from the nearer end of the range to the other one without pausing, the head stops
+        where it is as soon as a mark is raised.
+
+        :arg:
+            :param min_yaw: one end of the sweep, HeadYaw in rad
+            :type min_yaw: float
+            :param max_yaw: the other end of the sweep, HeadYaw in rad
+            :type max_yaw: float
+            :param head_pitch: HeadPitch kept during the sweep in rad
+            :type head_pitch: float
+            :param max_age: a mark raised within these seconds is returned without moving the head
+            :type max_age: float
+        :return:
+            the "LandmarkDetected" value, None if no mark was seen during the sweep
+            :rtype: list
+        """
+        if max_age > 0:
+            mark_data = self.latest(max_age)
+            if mark_data is not None:
+                return mark_data
+        self.start()
+        with self._lock:
+            self._found.clear()
+            self.markData = None
+        ends = [min_yaw, max_yaw]
+        head_yaw = self.motionProxy.getAngles("HeadYaw", True)[0]
+        if abs(head_yaw - max_yaw) < abs(head_yaw - min_yaw):
+            ends.reverse()
+        # The mark may already be raised while the head turns to the start of the sweep.
+        for head_yaw, speed in zip(ends, (0.3, self.sweepSpeed)):
+            mark_data = self.__move_head(head_yaw, head_pitch, speed)
+            if mark_data is not None:
+                return mark_data
+        return None
+
+    def __move_head(self, head_yaw, head_pitch, speed):
+        """
+        Move the head without blocking and stop it when a mark is raised.
+
+        :return:
+            the "LandmarkDetected" value raised before the head arrived, None if there is none
+            :rtype: list
+        """
+        task_id = self.motionProxy.post.angleInterpolationWithSpeed(["HeadYaw", "HeadPitch"],
+                                                                   [head_yaw, head_pitch], speed)
+        while self.motionProxy.isRunning(task_id):
+            if self._found.wait(0.02):
+                with self._lock:
+                    mark_data = self.markData
+                if mark_data is not None:
+                    self.motionProxy.stop(task_id)
+                    return mark_data
+        with self._lock:
+            return self.markData
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2023/12/20 10:05
+@Author  : Evan Wong
+@File    : landmark_tracker.py
+@Project : NAOGolf
+@Description: Landmark position kept in the odometry frame, searched again only when it is too uncertain
+"""
+
+import numpy as np
+
+# 99% gate of a 2D measurement (chi-square, 2 degrees of freedom)
+GATE_THRESHOLD = 9.21
+
+
+class LandmarkTracker(object):
+    """
+    Estimate of the landmark (the hole) in the odometry frame.
+
+    A sighting is moved from the robot frame into the odometry frame with ALMotion.getRobotPosition(), the
+    landmark does not move, so after a walk its position in the robot frame follows from the odometry alone.
+    The odometry drifts with the distance walked and the angle turned, which grows the uncertainty of the
+    estimate, the head sweep of LandMarkDetect runs again only once the bearing is too uncertain.
+    """
+
+    def __init__(self, landmark_detector, motion_proxy=None, measure_sigma=0.05, measure_sigma_per_meter=0.1,
+                 measure_bearing_sigma=0.03, odometry_sigma_per_meter=0.1, odometry_sigma_per_rad=0.1,
+                 max_bearing_sigma=0.1):
+        """
+        Initialization.
+
+        :arg:
+            :param landmark_detector: the detector providing the sightings
+            :type landmark_detector: LandMarkDetect
+            :param motion_proxy: ALMotion proxy for the odometry, None to use the one of the detector
+            :type motion_proxy: ALProxy
+            :param measure_sigma: standard deviation of the distance of a sighting right in front of the robot
+                                  in meter, the distance follows from the size of the mark
+            :type measure_sigma: float
+            :param measure_sigma_per_meter: growth of the distance standard deviation with the distance
+            :type measure_sigma_per_meter: float
+            :param measure_bearing_sigma: standard deviation of the bearing of a sighting in rad
+            :type measure_bearing_sigma: float
+            :param odometry_sigma_per_meter: odometry drift in meter per meter walked
+            :type odometry_sigma_per_meter: float
+            :param odometry_sigma_per_rad: odometry drift in rad per rad turned
+            :type odometry_sigma_per_rad: float
+            :param max_bearing_sigma: largest standard deviation of the landmark bearing in rad before a new search
+            :type max_bearing_sigma: float
+        :return: None
+        """
+        self.landmarkDetector = landmark_detector
+        self.motionProxy = motion_proxy
+        self.measureSigma = measure_sigma
+        self.measureSigmaPerMeter = measure_sigma_per_meter
+        self.measureBearingSigma = measure_bearing_sigma
+        self.odometrySigmaPerMeter = odometry_sigma_per_meter
+        self.odometrySigmaPerRad = odometry_sigma_per_rad
+        self.maxBearingSigma = max_bearing_sigma
+        self.state = None  # [x, y] in the odometry frame
+        self.covariance = None
+        self.searchCount = 0
+        self._odometry = (0.0, 0.0, 0.0)
+
+    def reset(self):
+        """
+        Drop the estimate, the next update searches the landmark.
+
+        :return: None
+        """
+        self.state = None
+        self.covariance = None
+
+    def update(self, force_search=False):
+        """
+        Move the estimate along the odometry walked since the last update, search the landmark when the
+        estimate is missing or too uncertain.
+
+        :arg:
+            :param force_search: search the landmark even if the estimate is good enough
+            :type force_search: bool
+        :return: None
+        """
+        motion_proxy = self.motionProxy or self.landmarkDetector.motionProxy
+        self.predict(tuple(motion_proxy.getRobotPosition(False)))
+        if not force_search and self.is_tracking:
+            return
+
+        self.landmarkDetector.update_landmark_data()
+        self.searchCount += 1
+        if not self.landmarkDetector.landmark.landmark_flag:
+            return
+        measurement, noise = self.__measurement(self.landmarkDetector.landmark.dis_x,
+                                                self.landmarkDetector.landmark.dis_y)
+        if self.state is not None:
+            innovation = measurement - self.state
+            innovation_cov = self.covariance + noise
+            if innovation.dot(np.linalg.solve(innovation_cov, innovation)) <= GATE_THRESHOLD:
+                gain = self.covariance.dot(np.linalg.inv(innovation_cov))
+                self.state = self.state + gain.dot(innovation)
+                self.covariance = (np.eye(2) - gain).dot(self.covariance)
+                return
+        # First sighting, or the odometry has drifted further than it was expected to.
+        self.state = measurement
+        self.covariance = noise
+
+    def predict(self, odometry):
+        """
+        Move to a new odometry, the drift since the last one is added to the uncertainty.
+
+        :arg:
+            :param odometry: [x, y, theta] from ALMotion.getRobotPosition()
+            :type odometry: tuple
+        :return: None
+        """
+        if self.state is not None:
+            walked = np.hypot(odometry[0] - self._odometry[0], odometry[1] - self._odometry[1])
+            turn = odometry[2] - self._odometry[2]
+            turned = abs(np.arctan2(np.sin(turn), np.cos(turn)))
+            # A heading error moves the landmark sideways by its distance.
+            distance = np.hypot(*(self.state - odometry[:2]))
+            sigma = np.hypot(self.odometrySigmaPerMeter * walked, self.odometrySigmaPerRad * turned * distance)
+            self.covariance = self.covariance + np.eye(2) * sigma ** 2
+        self._odometry = odometry
+
+    def __measurement(self, dis_x, dis_y):
+        """
+        Get a sighting in the odometry frame and its noise.
+
+        :return:
+            (measurement, 2 * 2 noise covariance)
+            :rtype: tuple
+        """
+        distance = np.hypot(dis_x, dis_y)
+        x, y, theta = self._odometry
+        measurement = np.array([x + dis_x * np.cos(theta) - dis_y * np.sin(theta),
+                                y + dis_x * np.sin(theta) + dis_y * np.cos(theta)])
+        # The bearing of a mark is much more precise than its distance, so the noise is stretched along the ray.
+        direction = np.arctan2(dis_y, dis_x) + theta
+        rotation = np.array([[np.cos(direction), -np.sin(direction)], [np.sin(direction), np.cos(direction)]])
+        sigmas = [self.measureSigma + self.measureSigmaPerMeter * distance, self.measureBearingSigma * distance]
+        return measurement, rotation.dot(np.diag(np.square(sigmas))).dot(rotation.T)
+
+    def __relative(self):
+        """
+        Get the estimate in the robot frame of the last odometry.
+
+        :return:
+            [disX, disY]
+            :rtype: np.ndarray
+        """
+        x, y, theta = self._odometry
+        rotation = np.array([[np.cos(theta), np.sin(theta)], [-np.sin(theta), np.cos(theta)]])
+        return rotation.dot(self.state - (x, y))
+
+    @property
+    def bearing_sigma(self):
+        """
+        Get the standard deviation of the landmark bearing.
+
+        :return:
+            standard deviation in rad, inf if there is no estimate
+            :rtype: float
+        """
+        if self.state is None:
+            return float("inf")
+        ray = self.state - self._odometry[:2]
+        distance = np.hypot(*ray)
+        # Only the uncertainty across the line of sight changes the bearing.
+        across = np.array([-ray[1], ray[0]]) / max(distance, 1e-6)
+        return float(np.arctan2(np.sqrt(across.dot(self.covariance).dot(across)), distance))
+
+    @property
+    def is_tracking(self):
+        """
+        Whether the estimate is good enough to be used without searching the landmark.
+
+        :return:
+            True means usable else not.
+            :rtype: bool
+        """
+        return self.bearing_sigma <= self.maxBearingSigma
+
+    @property
+    def landmark_data(self):
+        """
+        Get the landmark in the current robot frame, laid out as LandMarkDetect.get_landmark_data().
+
+        :return:
+            [disX, disY, dist, yawAngle], zeros if there is no estimate
+            :rtype: list
+        """
+        if self.state is None:
+            return [0, 0, 0, 0]
+        dis_x, dis_y = [float(value) for value in self.__relative()]
+        return [dis_x, dis_y, float(np.hypot(dis_x, dis_y)), float(np.arctan2(dis_x, dis_y))]
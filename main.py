@@ -19,9 +19,10 @@ if __name__ == '__main__':
     # stickDetector.postureProxy.goToPosture("StandInit", 0.2)
     client = 'test13221'
     # stickDetector.slider(client)
+    stickDetector.start_streaming(client)
     while True:
         stickDetector.update_stick_data(client)
-        cv2.imshow("window_name", cv2.cvtColor(stickDetector.frame_array, cv2.COLOR_HSV2BGR_FULL))
+        cv2.imshow("window_name", cv2.cvtColor(stickDetector.frame_view, cv2.COLOR_HSV2BGR_FULL))
         stickDetector.show_stick_position()
         stickDetector.show_gray_frame()
         cv2.waitKey(10)
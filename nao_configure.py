@@ -16,7 +16,7 @@ class NAOConfigure(object):
         Basic NAO robot class with some proxies.
 
         :arg:
-            :param ip: the ip address of a NAO robot
+            :param ip: the ip address of a NAO robot, None to work offline without any proxy
             :type ip: str
             :param port: the port to connect NAO robot (9559, default)
             :type port: int
@@ -26,6 +26,12 @@ class NAOConfigure(object):
         self.ip = ip
         self.port = port
 
+        if ip is None:
+            # Offline mode, such as replaying a frame log, no proxy is created.
+            self.ttsProxy = self.memoryProxy = self.cameraProxy = self.motionProxy = None
+            self.postureProxy = self.landmarkProxy = self.autonomousLifeProxy = None
+            return
+
         try:
             self.ttsProxy = ALProxy("ALTextToSpeech", self.ip, self.port)
             self.memoryProxy = ALProxy("ALMemory", self.ip, self.port)
@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2023/12/16 14:26
+@Author  : Evan Wong
+@File    : param_sweep.py
+@Project : NAOGolf
+@Description: Sweep HSV thresholds and Hough parameters over labelled frame logs on all CPU cores
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import collections
+import multiprocessing
+
+import numpy as np
+
+from frame_log import FrameReplay
+from golf_ball_detect import GolfBallDetect, BALL_ENGINES
+from stick_detect import StickDetect
+from ball_benchmark import is_same_ball
+
+LABELS_FILE = "labels.json"
+
+# Values tried for each parameter, every combination is one configuration.
+BALL_GRID = collections.OrderedDict([("engine", BALL_ENGINES),
+                                     ("max_h", (8, 10, 12)),
+                                     ("min_h2", (156,)),
+                                     ("min_s", (35, 43, 55)),
+                                     ("min_v", (30, 46)),
+                                     ("param1", (100, 150)),
+                                     ("param2", (12, 15, 20))])
+STICK_GRID = collections.OrderedDict([("min_h", (40, 45, 50)),
+                                      ("max_h", (65, 70, 75)),
+                                      ("min_s", (60, 75, 90)),
+                                      ("min_v", (51,)),
+                                      ("min_aspect_ratio", (0.6, 0.8, 1.0))])
+
+
+class LabelledReplay(FrameReplay):
+    """
+    Replay of the labelled records of a frame log only.
+    """
+
+    def __init__(self, log_path, indices):
+        """
+        Initialization.
+
+        :arg:
+            :param log_path: path of the frame log
+            :type log_path: str
+            :param indices: indices of the labelled records
+            :type indices: list
+        :return: None
+        """
+        super(LabelledReplay, self).__init__(log_path)
+        self.indices = sorted(indices)
+
+    def get_frame(self, camera_id, newer_than=0, client=None):
+        """
+        Get the next labelled frame of the given camera, frame ids are record indices + 1.
+        """
+        for index in self.indices:
+            if index >= newer_than:
+                record = self.log.record(index)
+                if record.frame.cameraID == camera_id:
+                    self.current = record
+                    return record.frame
+        return None
+
+
+def load_labels(directory):
+    """
+    Load the labels of the frame logs of a directory.
+
+    labels.json maps a log file name to its labelled records, keyed by record index:
+    {"field.flog": {"0": {"ball": [centerX, centerY, radius]}, "7": {"ball": null, "stick": [x, y, w, h]}}},
+    null means the object is not in the frame.
+
+    :arg:
+        :param directory: directory holding the frame logs and labels.json
+        :type directory: str
+    :return:
+        {log path: {record index: label}}
+        :rtype: dict
+    """
+    with open(os.path.join(directory, LABELS_FILE)) as label_file:
+        labels = json.load(label_file)
+    return dict((os.path.join(directory, name), dict((int(index), label) for index, label in records.items()))
+                for name, records in labels.items())
+
+
+def grid_configs(grid):
+    """
+    Get every configuration of a parameter grid.
+
+    :arg:
+        :param grid: parameter name -> values
+        :type grid: collections.OrderedDict
+    :return:
+        list of parameter name -> value
+        :rtype: list
+    """
+    return [collections.OrderedDict(zip(grid.keys(), values)) for values in itertools.product(*grid.values())]
+
+
+def overlap_ratio(rect, reference):
+    """
+    Intersection over union of two rectangles.
+
+    :arg:
+        :param rect: [x, y, w, h]
+        :type rect: list
+        :param reference: [x, y, w, h]
+        :type reference: list
+    :return:
+        the ratio in [0, 1]
+        :rtype: float
+    """
+    x0, y0 = max(rect[0], reference[0]), max(rect[1], reference[1])
+    x1 = min(rect[0] + rect[2], reference[0] + reference[2])
+    y1 = min(rect[1] + rect[3], reference[1] + reference[3])
+    intersection = max(0, x1 - x0) * max(0, y1 - y0)
+    union = rect[2] * rect[3] + reference[2] * reference[3] - intersection
+    return 1.0 * intersection / union if union > 0 else 0.0
+
+
+def run_ball_config(labels, config):
+    """
+    Run ball detection with one configuration over the labelled frames.
+
+    :return:
+        (latencies in seconds, [(detected [centerX, centerY, radius], label or None)])
+        :rtype: tuple
+    """
+    latencies = []
+    pairs = []
+    for log_path, records in labels.items():
+        indices = [index for index, label in records.items() if "ball" in label]
+        if len(indices) == 0:
+            continue
+        replay = LabelledReplay(log_path, indices)
+        detector = GolfBallDetect(None, engine=config["engine"])
+        detector.houghParams = {"param1": config["param1"], "param2": config["param2"]}
+        replay.attach(detector)
+        try:
+            while True:
+                last_frame_id = detector.frameID
+                start = time.time()
+                detector.update_ball_data(low_min_hsv=np.array([0, config["min_s"], config["min_v"]]),
+                                          low_max_hsv=np.array([config["max_h"], 255, 255]),
+                                          high_min_hsv=np.array([config["min_h2"], config["min_s"],
+                                                                 config["min_v"]]),
+                                          high_max_hsv=np.array([180, 255, 255]))
+                end = time.time()
+                if detector.frameID == last_frame_id:
+                    break
+                latencies.append(end - start)
+                pairs.append((detector.ball_data, records[detector.frameID - 1]["ball"]))
+        finally:
+            replay.close()
+    return latencies, pairs
+
+
+def run_stick_config(labels, config):
+    """
+    Run stick detection with one configuration over the labelled frames.
+
+    :return:
+        (latencies in seconds, [(detected [x, y, w, h] or [], label or None)])
+        :rtype: tuple
+    """
+    latencies = []
+    pairs = []
+    for log_path, records in labels.items():
+        indices = [index for index, label in records.items() if "stick" in label]
+        if len(indices) == 0:
+            continue
+        replay = LabelledReplay(log_path, indices)
+        detector = StickDetect(None)
+        replay.attach(detector)
+        try:
+            while True:
+                last_frame_id = detector.frameID
+                start = time.time()
+                detector.update_stick_data(min_hsv=np.array([config["min_h"], config["min_s"], config["min_v"]]),
+                                           max_hsv=np.array([config["max_h"], 255, 255]),
+                                           min_aspect_ratio=config["min_aspect_ratio"])
+                end = time.time()
+                if detector.frameID == last_frame_id:
+                    break
+                latencies.append(end - start)
+                pairs.append((list(detector.stick.boundRect), records[detector.frameID - 1]["stick"]))
+        finally:
+            replay.close()
+    return latencies, pairs
+
+
+def evaluate(job):
+    """
+    Evaluate one configuration, run in the worker processes.
+
+    :arg:
+        :param job: (target "ball" or "stick", labels, configuration)
+        :type job: tuple
+    :return:
+        (configuration, accuracy, recall, false positives, frames, mean ms, p95 ms)
+        :rtype: tuple
+    """
+    target, labels, config = job
+    if target == "ball":
+        latencies, pairs = run_ball_config(labels, config)
+        found = [ball[2] != 0 for ball, label in pairs]
+        correct = [is_same_ball(ball, label or [0, 0, 0]) for ball, label in pairs]
+    else:
+        latencies, pairs = run_stick_config(labels, config)
+        found = [len(rect) != 0 for rect, label in pairs]
+        correct = [overlap_ratio(rect, label) >= 0.5 if label and rect else not label and not rect
+                   for rect, label in pairs]
+    if len(pairs) == 0:
+        return config, 0.0, 0.0, 0, 0, 0.0, 0.0
+    present = [label is not None for ball, label in pairs]
+    hits = sum(1 for ok, has in zip(correct, present) if ok and has)
+    false_positives = sum(1 for is_found, has in zip(found, present) if is_found and not has)
+    recall = 1.0 * hits / max(1, sum(present))
+    latencies = np.array(latencies) * 1000
+    return (config, float(np.mean(correct)), recall, false_positives, len(pairs),
+            latencies.mean(), np.percentile(latencies, 95))
+
+
+def _quiet_worker():
+    # The detectors print a lot on every frame, keep the report readable.
+    sys.stdout = open(os.devnull, "w")
+
+
+def sweep(labels, target, grid, processes=None):
+    """
+    Evaluate every configuration of a grid, spread across the CPU cores.
+
+    :arg:
+        :param labels: labels returned by load_labels()
+        :type labels: dict
+        :param target: "ball" or "stick"
+        :type target: str
+        :param grid: parameter name -> values
+        :type grid: collections.OrderedDict
+        :param processes: worker processes, None for all the cores
+        :type processes: int
+    :return:
+        results of evaluate(), in the order of the configurations
+        :rtype: list
+    """
+    pool = multiprocessing.Pool(processes or multiprocessing.cpu_count(), _quiet_worker)
+    try:
+        return pool.map(evaluate, [(target, labels, config) for config in grid_configs(grid)], chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def report(target, results, min_accuracy, top):
+    """
+    Print the configurations meeting the accuracy target, fastest first.
+
+    :return: None
+    """
+    print "== %s: %d configurations" % (target, len(results))
+    passed = sorted((result for result in results if result[1] >= min_accuracy), key=lambda result: result[5])
+    if len(passed) == 0:
+        print "No configuration reaches accuracy %.3f, the most accurate ones:" % min_accuracy
+        passed = sorted(results, key=lambda result: (-result[1], result[5]))
+    print "%8s %8s %6s %8s %10s %10s  %s" % ("accuracy", "recall", "fp", "frames", "mean ms", "p95 ms", "params")
+    for config, accuracy, recall, false_positives, frames, mean_ms, p95_ms in passed[:top]:
+        params = " ".join("%s=%s" % item for item in config.items())
+        print "%8.3f %8.3f %6d %8d %10.2f %10.2f  %s" % (accuracy, recall, false_positives, frames,
+                                                       mean_ms, p95_ms, params)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Sweep detection parameters over labelled frame logs.")
+    parser.add_argument("directory", help="directory of frame logs with a " + LABELS_FILE)
+    parser.add_argument("--target", default="both", choices=["ball", "stick", "both"])
+    parser.add_argument("--min-accuracy", type=float, default=0.9,
+                        help="accuracy a configuration needs to be listed")
+    parser.add_argument("--processes", type=int, default=None, help="worker processes, all cores by default")
+    parser.add_argument("--top", type=int, default=10, help="how many configurations to list")
+    args = parser.parse_args()
+
+    frame_labels = load_labels(args.directory)
+    targets = ["ball", "stick"] if args.target == "both" else [args.target]
+    for name in targets:
+        report(name, sweep(frame_labels, name, BALL_GRID if name == "ball" else STICK_GRID, args.processes),
+               args.min_accuracy, args.top)
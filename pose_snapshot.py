@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2023/12/14 10:22
+@Author  : Evan Wong
+@File    : pose_snapshot.py
+@Project : NAOGolf
+@Description: Head pose of one tick read with a single ALMemory call and shared by all the detectors
+"""
+
+import time
+
+import numpy as np
+
+HEAD_JOINTS = ("HeadYaw", "HeadPitch")
+HEAD_JOINT_KEYS = ["Device/SubDeviceList/%s/Position/Sensor/Value" % joint for joint in HEAD_JOINTS]
+
+# NAO V5 head chain: the neck above the torso, then the cameras from the head frame,
+# (x, y, z) in meter and the pitch of the optical axis in rad.
+NECK_OFFSET = (0.0, 0.0, 0.1265)
+CAMERA_OFFSETS = {"Head": ((0.0, 0.0, 0.0), 0.0),
+                  "CameraTop": ((0.05871, 0.0, 0.06364), 0.0209),
+                  "CameraBottom": ((0.05071, 0.0, 0.01774), 0.6929)}
+
+
+def _translation(x, y, z):
+    transform = np.eye(4)
+    transform[:3, 3] = (x, y, z)
+    return transform
+
+
+def _rotation_y(angle):
+    transform = np.eye(4)
+    transform[0, 0] = transform[2, 2] = np.cos(angle)
+    transform[0, 2] = np.sin(angle)
+    transform[2, 0] = -np.sin(angle)
+    return transform
+
+
+def _rotation_z(angle):
+    transform = np.eye(4)
+    transform[0, 0] = transform[1, 1] = np.cos(angle)
+    transform[0, 1] = -np.sin(angle)
+    transform[1, 0] = np.sin(angle)
+    return transform
+
+
+def position_6d(transform):
+    """
+    Convert a homogeneous transform to a 6D position, as returned by ALMotion.getPosition().
+
+    :arg:
+        :param transform: 4 * 4 transform
+        :type transform: np.ndarray
+    :return:
+        [x, y, z, wx, wy, wz]
+        :rtype: list
+    """
+    wx = np.arctan2(transform[2, 1], transform[2, 2])
+    wy = np.arctan2(-transform[2, 0], np.hypot(transform[2, 1], transform[2, 2]))
+    wz = np.arctan2(transform[1, 0], transform[0, 0])
+    return [float(value) for value in transform[:3, 3]] + [float(wx), float(wy), float(wz)]
+
+
+def transform_from_6d(position):
+    """
+    Convert a 6D position to a homogeneous transform, the inverse of position_6d().
+
+    :arg:
+        :param position: [x, y, z, wx, wy, wz]
+        :type position: list
+    :return:
+        4 * 4 transform
+        :rtype: np.ndarray
+    """
+    x, y, z, wx, wy, wz = position[:6]
+    rotation_x = np.eye(4)
+    rotation_x[1, 1] = rotation_x[2, 2] = np.cos(wx)
+    rotation_x[1, 2] = -np.sin(wx)
+    rotation_x[2, 1] = np.sin(wx)
+    return _translation(x, y, z).dot(_rotation_z(wz)).dot(_rotation_y(wy)).dot(rotation_x)
+
+
+class PoseSnapshot(object):
+    """
+    Head angles and camera transforms of the current tick.
+
+    The head joints are read with one ALMemory.getListData() call and the camera transforms follow from the
+    head chain, the torso transform changes only with the legs and is refreshed from ALMotion now and then.
+    A snapshot younger than max_age is reused, so the detectors of one tick share one read.
+    With a PoseHistory attached, queries given a frame timestamp use the head pose at that time instead.
+    """
+
+    def __init__(self, motion_proxy, memory_proxy, max_age=0.03, torso_period=1.0):
+        """
+        Initialization.
+
+        :arg:
+            :param motion_proxy: ALMotion proxy, used for the torso transform
+            :type motion_proxy: ALProxy
+            :param memory_proxy: ALMemory proxy, used for the head joints
+            :type memory_proxy: ALProxy
+            :param max_age: how long in seconds a snapshot is reused
+            :type max_age: float
+            :param torso_period: how long in seconds the torso transform is reused
+            :type torso_period: float
+        :return: None
+        """
+        self.motionProxy = motion_proxy
+        self.memoryProxy = memory_proxy
+        self.maxAge = max_age
+        self.torsoPeriod = torso_period
+        self.timestamp = 0.0
+        self.headAngles = (0.0, 0.0)
+        self._torso = np.eye(4)
+        self._torsoTimestamp = 0.0
+        self._transforms = {}
+        self.history = None
+
+    def attach_history(self, history):
+        """
+        Answer queries with a frame timestamp from a joint history.
+
+        :arg:
+            :param history: the running joint history, None to detach
+            :type history: PoseHistory
+        :return: None
+        """
+        self.history = history
+
+    def update(self, force=False):
+        """
+        Read the head joints if the snapshot is older than maxAge.
+
+        :arg:
+            :param force: read even if the snapshot is fresh, such as right after capturing the frames of a tick
+            :type force: bool
+        :return: None
+        """
+        now = time.time()
+        if not force and now - self.timestamp <= self.maxAge:
+            return
+        self._update_torso(now)
+        head_yaw, head_pitch = self.memoryProxy.getListData(HEAD_JOINT_KEYS)
+        self.headAngles = (head_yaw, head_pitch)
+        self.timestamp = now
+        self._transforms = {}
+
+    def _update_torso(self, now):
+        """
+        Read the torso transform if it is older than torsoPeriod.
+
+        :arg:
+            :param now: current time in seconds
+            :type now: float
+        :return: None
+        """
+        if now - self._torsoTimestamp > self.torsoPeriod:
+            # 2 means FRAME_ROBOT
+            self._torso = np.array(self.motionProxy.getTransform("Torso", 2, True)).reshape([4, 4])
+            self._torsoTimestamp = now
+            self._transforms = {}
+
+    def get_head_angles(self, timestamp=None):
+        """
+        Get the head angles.
+
+        :arg:
+            :param timestamp: capture time of a frame, None for the current snapshot
+            :type timestamp: float
+        :return:
+            [HeadYaw, HeadPitch] in rad
+            :rtype: list
+        """
+        if timestamp and self.history is not None:
+            angles = self.history.angles_at(timestamp)
+            if angles is not None:
+                return angles
+        self.update()
+        return list(self.headAngles)
+
+    def transform(self, name, timestamp=None):
+        """
+        Transform of the head or a camera in FRAME_ROBOT.
+
+        :arg:
+            :param name: "Head", "CameraTop" or "CameraBottom"
+            :type name: str
+            :param timestamp: capture time of a frame, None for the current snapshot
+            :type timestamp: float
+        :return:
+            4 * 4 transform
+            :rtype: np.ndarray
+        :raise: KeyError
+        """
+        head_yaw, head_pitch = self.get_head_angles(timestamp)
+        self._update_torso(time.time())
+        key = (name, head_yaw, head_pitch)
+        transform = self._transforms.get(key)
+        if transform is None:
+            if len(self._transforms) >= 16:
+                # Poses looked up from the history change with every frame.
+                self._transforms = {}
+            (x, y, z), camera_pitch = CAMERA_OFFSETS[name]
+            transform = (self._torso.dot(_translation(*NECK_OFFSET)).dot(_rotation_z(head_yaw))
+                         .dot(_rotation_y(head_pitch)).dot(_translation(x, y, z)).dot(_rotation_y(camera_pitch)))
+            self._transforms[key] = transform
+        return transform
+
+    def get_position(self, name, timestamp=None):
+        """
+        Same as ALMotion.getPosition(name, 2, True), at the given time if known.
+
+        :arg:
+            :param name: "Head", "CameraTop" or "CameraBottom"
+            :type name: str
+            :param timestamp: capture time of a frame, None for the current snapshot
+            :type timestamp: float
+        :return:
+            [x, y, z, wx, wy, wz]
+            :rtype: list
+        """
+        return position_6d(self.transform(name, timestamp))
+
+    def get_transform(self, name, timestamp=None):
+        """
+        Same as ALMotion.getTransform(name, 2, True), at the given time if known.
+
+        :arg:
+            :param name: "Head", "CameraTop" or "CameraBottom"
+            :type name: str
+            :param timestamp: capture time of a frame, None for the current snapshot
+            :type timestamp: float
+        :return:
+            the 16 values of the transform, row major
+            :rtype: list
+        """
+        return [float(value) for value in self.transform(name, timestamp).flat]
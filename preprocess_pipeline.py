@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2023/12/18 09:40
+@Author  : Evan Wong
+@File    : preprocess_pipeline.py
+@Project : NAOGolf
+@Description: Binary image pre-processing writing into buffers kept between frames, with cached kernels
+"""
+
+import collections
+
+import cv2
+import numpy as np
+
+_kernels = {}
+
+
+def get_kernel(size):
+    """
+    Get the square structuring element of a size, built once.
+
+    :arg:
+        :param size: side of the kernel in pixels
+        :type size: int
+    :return:
+        the kernel, do not modify it
+        :rtype: np.ndarray
+    """
+    kernel = _kernels.get(size)
+    if kernel is None:
+        kernel = _kernels[size] = np.ones((size, size), np.uint8)
+    return kernel
+
+
+class PreprocessPipeline(object):
+    """
+    Pre-processing stages of a detector writing their results into buffers kept between frames. The buffer of
+    a stage grows to the largest image it has seen and smaller images (windows, coarse frames) get a view of its
+    corner, so that steady-state processing allocates nothing.
+
+    A result is only valid until the same stage runs again, keep a copy of it to hold it longer.
+    """
+
+    def __init__(self, max_buffers=16):
+        """
+        Initialization.
+
+        :arg:
+            :param max_buffers: buffers kept, the least recently used one is dropped beyond
+            :type max_buffers: int
+        :return: None
+        """
+        self.buffers = collections.OrderedDict()
+        self.maxBuffers = max_buffers
+
+    def buffer(self, name, shape, dtype=np.uint8):
+        """
+        Get the buffer of a stage for an image shape.
+
+        :arg:
+            :param name: name of the stage
+            :type name: str
+            :param shape: (height, width) or (height, width, channels)
+            :type shape: tuple
+            :param dtype: type of the buffer
+            :type dtype: type
+        :return:
+            view of the buffer shaped as asked, its content is left from the last use
+            :rtype: np.ndarray
+        """
+        height, width = shape[:2]
+        key = (name, tuple(shape[2:]), dtype)
+        buf = self.buffers.pop(key, None)
+        if buf is None or buf.shape[0] < height or buf.shape[1] < width:
+            size = (height, width) if buf is None else (max(height, buf.shape[0]), max(width, buf.shape[1]))
+            buf = np.empty(size + tuple(shape[2:]), dtype)
+            if len(self.buffers) >= self.maxBuffers:
+                self.buffers.popitem(last=False)
+        self.buffers[key] = buf
+        return buf[:height, :width]
+
+    def classify(self, color_table, hsv_img):
+        """
+        Label the pixels of an HSV image, see ColorTable.classify().
+
+        :arg:
+            :param color_table: color table of the thresholds
+            :type color_table: ColorTable
+            :param hsv_img: HSV image, the whole frame or a part of it
+            :type hsv_img: np.ndarray
+        :return:
+            label image shaped height * width
+            :rtype: np.ndarray
+        """
+        shape = hsv_img.shape[:2]
+        scratch = (self.buffer("lut", hsv_img.shape), [self.buffer(name, shape) for name in ("h", "s", "v")])
+        return color_table.classify(hsv_img, self.buffer("labels", shape), scratch)
+
+    def mask(self, color_table, labels, class_name):
+        """
+        Get the binary image of one class from a label image, see ColorTable.mask().
+
+        :return:
+            binary image, 255 for the pixels of the class
+            :rtype: np.ndarray
+        """
+        return color_table.mask(labels, class_name, self.buffer("mask", labels.shape))
+
+    def close_open(self, binary_img, kernel_size=5):
+        """
+        Fill the small holes of a binary image, then remove its small specks.
+
+        :arg:
+            :param binary_img: binary image
+            :type binary_img: np.ndarray
+            :param kernel_size: side of the square kernel
+            :type kernel_size: int
+        :return:
+            the opened image
+            :rtype: np.ndarray
+        """
+        kernel = get_kernel(kernel_size)
+        closed = cv2.morphologyEx(binary_img, cv2.MORPH_CLOSE, kernel, dst=self.buffer("closed", binary_img.shape))
+        return cv2.morphologyEx(closed, cv2.MORPH_OPEN, kernel, dst=self.buffer("opened", binary_img.shape))
+
+    def blur(self, img, kernel_size, sigma_x):
+        """
+        Gaussian blur of an image.
+
+        :arg:
+            :param img: image to blur
+            :type img: np.ndarray
+            :param kernel_size: (width, height) of the kernel
+            :type kernel_size: tuple
+            :param sigma_x: standard deviation in x-axis, 0 to compute it from the kernel size
+            :type sigma_x: float
+        :return:
+            the blurred image
+            :rtype: np.ndarray
+        """
+        return cv2.GaussianBlur(img, kernel_size, sigma_x, dst=self.buffer("blurred", img.shape))
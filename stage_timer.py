@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2023/12/17 10:05
+@Author  : Evan Wong
+@File    : stage_timer.py
+@Project : NAOGolf
+@Description: Per-stage timing of the vision pipelines, used by the vision benchmark
+"""
+
+import time
+import collections
+import contextlib
+
+import numpy as np
+
+
+class _NullStage(object):
+    """
+    Context doing nothing, used when no timer is attached so that untimed detection costs nothing.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_STAGE = _NullStage()
+
+
+class StageTimer(object):
+    """
+    Accumulate the time of named stages within a frame, then keep one sample per stage and frame.
+    """
+
+    def __init__(self):
+        """
+        Initialization.
+
+        :return: None
+        """
+        self.samples = collections.OrderedDict()
+        self._current = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Time a stage, a stage run several times in one frame adds up.
+
+        :arg:
+            :param name: name of the stage
+            :type name: str
+        :return: None
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self._current[name] = self._current.get(name, 0.0) + time.time() - start
+
+    def lap(self):
+        """
+        End the current frame, the stages it did not run get no sample.
+
+        :return: None
+        """
+        for name, duration in self._current.items():
+            self.samples.setdefault(name, []).append(duration)
+        self._current = collections.OrderedDict()
+
+    def discard(self):
+        """
+        Drop the stages timed since the last lap, such as a pass that found no new frame.
+
+        :return: None
+        """
+        self._current = collections.OrderedDict()
+
+    def summary(self, prefix=""):
+        """
+        Statistics of every stage in milliseconds.
+
+        :arg:
+            :param prefix: prefix of the stage names, such as "ball."
+            :type prefix: str
+        :return:
+            stage name -> {"frames", "mean_ms", "p95_ms", "max_ms"}
+            :rtype: collections.OrderedDict
+        """
+        stats = collections.OrderedDict()
+        for name, durations in self.samples.items():
+            durations = np.array(durations) * 1000
+            stats[prefix + name] = {"frames": len(durations),
+                                    "mean_ms": float(durations.mean()),
+                                    "p95_ms": float(np.percentile(durations, 95)),
+                                    "max_ms": float(durations.max())}
+        return stats
@@ -12,6 +12,89 @@ import numpy as np
 import vision_definitions as vd
 
 from visual_basis import VisualBasis
+from color_table import BALL_HSV_RANGES, STICK_CLASS, get_color_table
+
+# Stick detection engines of StickDetect
+STICK_ENGINES = ("contours", "profile")
+# Height of the yellow stick above the ground in meter, measure the one of the field
+STICK_HEIGHT = 0.47
+
+
+def find_stick_profile(binary_img, min_height, min_aspect_ratio, min_area=0, max_candidates=None):
+    """
+    Find tall and narrow runs of columns from the column and row projections of a binary image,
+    the cost hardly grows with the count of blobs, unlike tracing every contour.
+
+    :arg:
+        :param binary_img: binary image, non-zero pixels belong to the stick
+        :type binary_img: np.ndarray
+        :param min_height: minimum count of consecutive stick pixels in a column of the stick
+        :type min_height: float
+        :param min_aspect_ratio: minimum height / width of a run of columns, its height being the longest vertical
+                                 run in one of its columns
+        :type min_aspect_ratio: float
+        :param min_area: minimum width * height of a run
+        :type min_area: float
+        :param max_candidates: how many candidates to return, None for all
+        :type max_candidates: int
+    :return:
+        candidates [[x, y, w, h], ...] sorted by aspect ratio, largest first
+        :rtype: np.ndarray
+    """
+    min_height = max(1, int(min_height))
+    mask = cv2.threshold(binary_img, 0, 1, cv2.THRESH_BINARY)[1]
+    # Keep the vertical runs of at least min_height pixels only, the erosion takes min_height - 1 pixels off
+    # each of them, min_height // 2 at the top.
+    runs = cv2.erode(mask, np.ones((min_height, 1), np.uint8))
+    # Column projection: the stick is a run of columns holding a vertical run.
+    columns = cv2.reduce(runs, 0, cv2.REDUCE_SUM, dtype=cv2.CV_32S)[0]
+    tall = columns > 0
+    if not tall.any():
+        return np.zeros((0, 4), np.int64)
+    edges = np.diff(np.concatenate(([0], tall.astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    widths = np.flatnonzero(edges == -1) - starts
+    # A column sum bounds its longest run from above, runs of columns failing even with it are dropped
+    # before looking at the runs themselves.
+    bounds = np.maximum.reduceat(columns, starts) + min_height - 1
+    possible = (1.0 * bounds / widths > min_aspect_ratio) & (widths * bounds >= min_area)
+    starts, widths = starts[possible], widths[possible]
+    if len(starts) == 0:
+        return np.zeros((0, 4), np.int64)
+
+    # Vertical runs of the remaining columns: the changes down each column alternate between the top of a run
+    # and the row after its bottom.
+    left, right = starts[0], starts[-1] + widths[-1]
+    padded = cv2.copyMakeBorder(runs[:, left:right], 1, 1, 0, 0, cv2.BORDER_CONSTANT, value=0)
+    change_rows, change_columns = np.divmod(np.flatnonzero(padded[1:] != padded[:-1]), right - left)
+    by_column = np.lexsort((change_rows, change_columns))
+    change_rows, change_columns = change_rows[by_column], change_columns[by_column]
+    run_columns, run_tops, run_bottoms = change_columns[::2], change_rows[::2], change_rows[1::2]
+    # The longest run of each column, the first one on ties, so that separate runs in a column do not add up:
+    # the length and the top are packed into one key taking the maximum.
+    size = runs.shape[0] + 2
+    keys = np.zeros(right - left + 1, np.int64)
+    np.maximum.at(keys, run_columns, (run_bottoms - run_tops) * size + size - 1 - run_tops)
+    tops = size - 1 - keys % size
+    bottoms = tops + keys // size
+    # Reduce over [start, end) of each run of columns only, not over the columns between them.
+    segments = np.column_stack((starts - left, starts - left + widths)).ravel()
+
+    heights = np.maximum.reduceat(keys // size, segments)[::2] + min_height - 1
+    aspects = 1.0 * heights / widths
+    keep = (aspects > min_aspect_ratio) & (widths * heights >= min_area)
+    order = np.argsort(-aspects[keep], kind="mergesort")
+    selected = np.flatnonzero(keep)[order][:max_candidates]
+
+    # Rows spanned by the longest runs of the columns, plus the rows the erosion took off.
+    candidates = np.zeros((len(selected), 4), np.int64)
+    candidates[:, 0] = starts[selected]
+    candidates[:, 1] = np.maximum(np.minimum.reduceat(tops, segments)[::2][selected] - min_height // 2, 0)
+    bottom = np.minimum(np.maximum.reduceat(bottoms, segments)[::2][selected] + min_height - 1 - min_height // 2,
+                        runs.shape[0])
+    candidates[:, 2] = widths[selected]
+    candidates[:, 3] = bottom - candidates[:, 1]
+    return candidates
 
 
 class StickDetect(VisualBasis):
@@ -26,8 +109,12 @@ class StickDetect(VisualBasis):
             self.boundRect = []
             self.cropKeep = 1
             self.stickAngle = 0.0  # rad
+            self.stickPosition = {"disX": 0.0, "disY": 0.0}  # m, 0 when the range is unknown
+            self.stickHeight = STICK_HEIGHT  # m
+            self.roi = (0, 0, 0, 0)  # x0, y0, x1, y1 of the processed part of the frame
 
-    def __init__(self, ip, port=9559, camera_id=vd.kTopCamera, resolution=vd.kVGA, is_write=True):
+    def __init__(self, ip, port=9559, camera_id=vd.kTopCamera, resolution=vd.kVGA, is_write=True,
+                 engine="contours", is_tracking=False, max_misses=3):
         """
         Initialization.
 
@@ -42,12 +129,30 @@ class StickDetect(VisualBasis):
             :type resolution: int
             :param is_write: whether write current frame to specific directory, we actually not used it
             :type is_write: bool
+            :param engine: stick detection engine, "contours" (default) or "profile" (projection profiles,
+                           candidates verified with contours), whose cost hardly grows with the clutter of the mask
+            :type engine: str
+            :param is_tracking: whether to search only around the last stick once it has been found
+            :type is_tracking: bool
+            :param max_misses: misses around the last stick before searching the full crop again
+            :type max_misses: int
+        :raise: ValueError
         """
+        if engine not in STICK_ENGINES:
+            raise ValueError("engine must be one of " + ", ".join(STICK_ENGINES))
         super(StickDetect, self).__init__(ip, port, camera_id, resolution)
         self.stick = self.Stick()
         self.is_write = is_write
+        self.engine = engine
+        self.maxStickCandidates = 3
+        self.isTracking = is_tracking
+        self.maxMisses = max_misses
+        self.missCount = 0
+        self.trackState = None
+        # Rows kept above the horizon for the errors of the pose
+        self.horizonMargin = 20
 
-    def __get_preprocessed_image(self, min_hsv, max_hsv, crop_keep):
+    def __get_preprocessed_image(self, min_hsv, max_hsv, crop_top, roi=None):
         """
         Get pre-processed binary image from the HSV image (transformed from BGR image).
 
@@ -56,36 +161,41 @@ class StickDetect(VisualBasis):
             :type min_hsv: np.ndarray
             :param max_hsv: Higher threshold for yellow stick
             :type max_hsv: np.ndarray
-            :param crop_keep: crop ratio of image (>= 0.5)
-            :type crop_keep: float
+            :param crop_top: first row of the frame kept
+            :type crop_top: int
+            :param roi: (x0, y0, x1, y1) part of the cropped frame to process, None for the whole crop
+            :type roi: tuple
         :return:
             pre-processed binary image
             :rtype: np.ndarray
         """
-        self.stick.cropKeep = crop_keep
-        frame_array = self.frame_array
         height = self.frameHeight
+        self.stick.cropKeep = 1 - 1.0 * crop_top / height
+        # The ball ranges are included so that a ball detector reading the same frame reuses the labels.
+        color_table = get_color_table(BALL_HSV_RANGES, ((min_hsv, max_hsv),))
+        self.stick.roi = roi or (0, crop_top, self.frameWidth, height)
+        x0, y0, x1, y1 = self.stick.roi
 
         try:
-            cropped_frame = frame_array[int((1 - crop_keep) * height):, :]
+            labels = self.frame_labels(color_table, y0, y1, x0, x1)
         except IndexError:
             print "Error occurred when cropping the image"
         else:
-            hsv_img = cropped_frame
-            bin_img = cv2.inRange(hsv_img, min_hsv, max_hsv)
+            with self._stage("classify"):
+                bin_img = self.pipeline.mask(color_table, labels, STICK_CLASS)
 
             kernel_size = (9, 9)
-            kernel = np.ones((5, 5), np.uint8)
             sigma_x = 0
 
-            closed_frame = cv2.morphologyEx(bin_img, cv2.MORPH_CLOSE, kernel)
-            opened_frame = cv2.morphologyEx(closed_frame, cv2.MORPH_OPEN, kernel)
-            blured_frame = cv2.GaussianBlur(opened_frame, kernel_size, sigma_x)
+            with self._stage("morphology"):
+                opened_frame = self.pipeline.close_open(bin_img, 5)
+            with self._stage("blur"):
+                blured_frame = self.pipeline.blur(opened_frame, kernel_size, sigma_x)
             # cv2.imshow("stick bin", frameBin)
             # cv2.waitKey(20)
             return blured_frame
 
-    def __find_stick(self, preprocessed_img, min_perimeter, min_area, min_aspect_ratio):
+    def __find_stick(self, preprocessed_img, min_perimeter, min_area, min_aspect_ratio, offset=(0, 0)):
         """
         Find the stick at golf hole using some strategy.
 
@@ -98,6 +208,8 @@ class StickDetect(VisualBasis):
             :type min_area: float
             :param min_aspect_ratio: minimum aspect ratio of detected stick
             :type min_aspect_ratio: float
+            :param offset: (x, y) position of the image in the processed part of the frame
+            :type offset: tuple
         :return:
             Detected stick marked with rectangle or [].
             :rtype: np.ndarray
@@ -123,11 +235,48 @@ class StickDetect(VisualBasis):
 
         rects = np.array(rects)
         rect = rects[np.argmax(1.0 * (rects[:, -1]) / rects[:, -2]), ]
-        rect[1] += int(self.frameHeight * (1 - self.stick.cropKeep))
+        rect[0] += offset[0] + self.stick.roi[0]
+        rect[1] += offset[1] + self.stick.roi[1]
 
         return rect
 
-    def update_stick_data(self, client="test", crop_keep=0.75,
+    def __find_stick_profile(self, preprocessed_img, min_perimeter, min_area, min_aspect_ratio):
+        """
+        Find the stick from the projection profiles, then verify the candidates with contours
+        in small windows around them.
+
+        :arg:
+            :param preprocessed_img: Pre-processed image to be detected
+            :type preprocessed_img: np.ndarray
+            :param min_perimeter: minimum perimeter of detected stick
+            :type min_perimeter: float
+            :param min_area: minimum area of detected stick
+            :type min_area: float
+            :param min_aspect_ratio: minimum aspect ratio of detected stick
+            :type min_aspect_ratio: float
+        :return:
+            Detected stick marked with rectangle or [].
+            :rtype: np.ndarray
+        """
+        # A pole of perimeter p is at least about p / 4 high, the contours decide on the exact limits.
+        candidates = find_stick_profile(preprocessed_img, min_perimeter / 4, min_aspect_ratio, min_area / 2,
+                                        self.maxStickCandidates)
+        height, width = preprocessed_img.shape[:2]
+        margin = 8
+        rects = []
+        for x, y, w, h in candidates:
+            x0, y0 = max(0, x - margin), max(0, y - margin)
+            x1, y1 = min(width, x + w + margin), min(height, y + h + margin)
+            rect = self.__find_stick(preprocessed_img[y0:y1, x0:x1], min_perimeter, min_area, min_aspect_ratio,
+                                     (x0, y0))
+            if len(rect) != 0:
+                rects.append(rect)
+        if len(rects) == 0:
+            return []
+        rects = np.array(rects)
+        return rects[np.argmax(1.0 * (rects[:, -1]) / rects[:, -2]), ]
+
+    def update_stick_data(self, client="test", crop_keep=None,
                           min_hsv=np.array([45, 75, 51]),
                           max_hsv=np.array([70, 255, 255]),
                           min_aspect_ratio=0.8):
@@ -137,7 +286,7 @@ class StickDetect(VisualBasis):
         :arg:
             :param client: client name
             :type client: str
-            :param crop_keep: crop ratio of image (>= 0.5)
+            :param crop_keep: crop ratio of image (>= 0.5), None to keep the rows below the horizon only
             :type crop_keep: float
             :param min_hsv: Lower threshold for yellow stick
             :type min_hsv: np.ndarray
@@ -150,20 +299,130 @@ class StickDetect(VisualBasis):
         self.update_frame(client)
         min_perimeter = self.frameHeight / 8.0
         min_area = self.frameHeight * self.frameWidth / 1000.0
-        self._gray_frame = self.__get_preprocessed_image(min_hsv, max_hsv, crop_keep)
-        gray_frame = self.gray_frame
+        # The pose is needed before detecting to crop at the horizon and to move the tracked box with the head,
+        # else only once found.
+        camera_position = None
+        if crop_keep is None or self.trackState is not None:
+            camera_position = self.camera_position()
+        if crop_keep is None:
+            crop_top = self.ground_top_row(self.stick.stickHeight, self.horizonMargin, camera_position)
+        else:
+            crop_top = int((1 - crop_keep) * self.frameHeight)
 
-        rect = self.__find_stick(gray_frame, min_perimeter, min_area, min_aspect_ratio)
+        rect = []
+        roi = None
+        if crop_top < self.frameHeight:
+            roi = self.__predict_roi(camera_position, crop_top) if self.isTracking else None
+            self._gray_frame = self.__get_preprocessed_image(min_hsv, max_hsv, crop_top, roi)
+            gray_frame = self.gray_view
+
+            with self._stage(self.engine):
+                if self.engine == "profile":
+                    rect = self.__find_stick_profile(gray_frame, min_perimeter, min_area, min_aspect_ratio)
+                else:
+                    rect = self.__find_stick(gray_frame, min_perimeter, min_area, min_aspect_ratio)
+        else:
+            # Looking over the ground, the stick cannot be in sight.
+            self.stick.cropKeep = 0.0
+            self._gray_frame = np.zeros((0, self.frameWidth), np.uint8)
         if len(rect) == 0:
             self.stick.boundRect = []
             self.stick.stickAngle = 0.0
+            self.stick.stickPosition = {"disX": 0.0, "disY": 0.0}
+            self.missCount += 1
+            if roi is None or self.missCount >= self.maxMisses:
+                self.trackState = None
         else:
             self.stick.boundRect = rect
             center_x = rect[0] + rect[2] / 2
             self.stick.stickAngle = (1.0 * self.frameWidth / 2 - center_x) / self.frameWidth * self.cameraYawRange
-            camera_position = self.motionProxy.getPosition("Head", 2, True)  # 为何与之前的不同？
-            camera_y = camera_position[5]
-            self.stick.stickAngle += camera_y
+            with self._stage("position"):
+                if camera_position is None:
+                    camera_position = self.camera_position()
+                self.__update_stick_position(rect, camera_position)
+            self.stick.stickAngle += camera_position[5]
+            self.missCount = 0
+            if self.isTracking:
+                self.trackState = {"boundRect": list(rect), "cameraPitch": camera_position[4],
+                                   "cameraYaw": camera_position[5]}
+
+    def __update_stick_position(self, rect, camera_position):
+        """
+        Estimate the position of the stick on the ground from one frame. The distance is measured from the bottom
+        edge of its box, which stands on the ground, and from its pixel height against the known stick height,
+        averaged when both edges are in sight. Only the top edge at the stick height is left when the bottom one
+        is cut off.
+
+        :arg:
+            :param rect: [x, y, w, h] of the stick in the frame
+            :type rect: np.ndarray
+            :param camera_position: 6D position of the camera in FRAME_ROBOT
+            :type camera_position: list
+        :return: None
+        """
+        x, y, w, h = rect
+        x0, y0, x1, y1 = self.stick.roi
+        # An edge on the border of the processed part may be cut off.
+        # The 9 * 9 blur of the pre-processing grows the box by 4 pixels on every side.
+        is_top_seen = y > y0
+        is_bottom_seen = y + h < y1
+        y, h = y + 4, max(1, h - 8)
+        camera_x, camera_y, camera_height = camera_position[:3]
+        camera_pitch, camera_yaw = camera_position[4:6]
+
+        # 像素坐标系 -> 相机坐标系（angle）, rows below the horizon look down.
+        top_pitch = camera_pitch + (y - 1.0 * self.frameHeight / 2) * self.cameraPitchRange / self.frameHeight
+        bottom_pitch = camera_pitch + (y + h - 1.0 * self.frameHeight / 2) * self.cameraPitchRange / self.frameHeight
+
+        distances = []
+        if is_bottom_seen and bottom_pitch > 0.01:
+            distances.append(camera_height / np.tan(bottom_pitch))
+        if is_bottom_seen and is_top_seen and np.tan(bottom_pitch) - np.tan(top_pitch) > 1e-3:
+            distances.append(self.stick.stickHeight / (np.tan(bottom_pitch) - np.tan(top_pitch)))
+        if not is_bottom_seen and is_top_seen and abs(top_pitch) > 0.01:
+            distance = (camera_height - self.stick.stickHeight) / np.tan(top_pitch)
+            if distance > 0:
+                distances.append(distance)
+        if len(distances) == 0:
+            self.stick.stickPosition = {"disX": 0.0, "disY": 0.0}
+            return
+
+        # 投影到NAO坐标系
+        stick_yaw = (1.0 * self.frameWidth / 2 - (x + w / 2.0)) * self.cameraYawRange / self.frameWidth
+        distance = np.mean(distances) / np.cos(stick_yaw)
+        self.stick.stickPosition = {"disX": float(distance * np.cos(stick_yaw + camera_yaw) + camera_x),
+                                    "disY": float(distance * np.sin(stick_yaw + camera_yaw) + camera_y)}
+
+    def __predict_roi(self, camera_position, crop_top):
+        """
+        Predict the region of interest of the tracked stick, its last box moved by the head turn since then.
+
+        :arg:
+            :param camera_position: current 6D position of the camera in FRAME_ROBOT, None without a track
+            :type camera_position: list
+            :param crop_top: first row of the frame kept
+            :type crop_top: int
+        :return:
+            (x0, y0, x1, y1) in pixels, None if the whole crop should be searched
+            :rtype: tuple
+        """
+        track = self.trackState
+        if track is None or camera_position is None:
+            return None
+        x, y, w, h = track["boundRect"]
+        # Turning the head left moves the stick right in the frame, looking down moves it up.
+        x += int((camera_position[5] - track["cameraYaw"]) * self.frameWidth / self.cameraYawRange)
+        y -= int((camera_position[4] - track["cameraPitch"]) * self.frameHeight / self.cameraPitchRange)
+        # The robot may walk as well, leave room for the box to move and grow.
+        margin_x = max(2 * w, 40)
+        margin_y = max(h // 4, 20)
+        x0 = max(0, x - margin_x)
+        y0 = max(crop_top, y - margin_y)
+        x1 = min(self.frameWidth, x + w + margin_x)
+        y1 = min(self.frameHeight, y + h + margin_y)
+        if x1 - x0 < w or y1 - y0 < h // 2:
+            return None
+        return x0, y0, x1, y1
 
     def show_stick_position(self):
         """
@@ -174,7 +433,7 @@ class StickDetect(VisualBasis):
         print "stick status: " + str(self.is_stick_insight())
         if len(self.stick.boundRect) == 0:
             print "No stick detected!"
-            cv2.imshow("Stick Position", cv2.cvtColor(self.frame_array, cv2.COLOR_HSV2BGR_FULL))
+            cv2.imshow("Stick Position", cv2.cvtColor(self.frame_view, cv2.COLOR_HSV2BGR_FULL))
         else:
             [x, y, w, h] = self.stick.boundRect
             frame = self.frame_array
@@ -211,13 +470,24 @@ class StickDetect(VisualBasis):
             min_aspect_ratio = 0.8
             crop_keep = 0.75
             self.update_stick_data(client, crop_keep, min_hsv, max_hsv, min_aspect_ratio)
-            cv2.imshow(window_name, cv2.cvtColor(self.frame_array, cv2.COLOR_HSV2BGR_FULL))
+            cv2.imshow(window_name, cv2.cvtColor(self.frame_view, cv2.COLOR_HSV2BGR_FULL))
             self.show_stick_position()
             self.show_gray_frame()
             k = cv2.waitKey(10) & 0xFF
             if k == 27:
                 break
 
+    @property
+    def stick_position(self):
+        """
+        Get the stick's position.
+
+        :return:
+            distance in x-axis, distance in y-axis (0 when the range is unknown) and direction related to Nao.
+            :rtype: list
+        """
+        return [self.stick.stickPosition["disX"], self.stick.stickPosition["disY"], self.stick.stickAngle]
+
     def is_stick_insight(self):
         """
         Return whether the golf stick is in NAO robot's sight.
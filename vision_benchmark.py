@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2023/12/17 11:30
+@Author  : Evan Wong
+@File    : vision_benchmark.py
+@Project : NAOGolf
+@Description: Time every stage of the vision pipelines on a frame log and fail on regressions
+"""
+
+import os
+import sys
+import json
+import argparse
+import collections
+
+import numpy as np
+import vision_definitions as vd
+
+from frame_bus import Frame
+from frame_log import FrameReplay
+from stage_timer import StageTimer
+from golf_ball_detect import GolfBallDetect
+from stick_detect import StickDetect, STICK_ENGINES
+from landmark_detect import LandMarkDetect
+
+# Mark angles [alpha, beta, sizeX] fed to the landmark geometry, replayed frames carry no landmark detection.
+BENCH_MARKS = [[0.1, -0.05, 0.1], [-0.3, 0.02, 0.06], [0.45, 0.1, 0.15]]
+# Largest distance in meter between the landmark positions and the ones of the almath transform chain
+ALMATH_TOLERANCE = 1e-6
+
+
+class DecodingReplay(FrameReplay):
+    """
+    Replay handing every frame through Frame.from_image(), so that decoding an image container is timed too.
+    """
+
+    def __init__(self, log_path, timer):
+        """
+        Initialization.
+
+        :arg:
+            :param log_path: path of the frame log
+            :type log_path: str
+            :param timer: timer of the detector reading this replay
+            :type timer: StageTimer
+        :return: None
+        """
+        super(DecodingReplay, self).__init__(log_path)
+        self.timer = timer
+
+    def get_frame(self, camera_id, newer_than=0, client=None):
+        """
+        Get the next recorded frame of the given camera, decoded from an image container.
+        """
+        frame = super(DecodingReplay, self).get_frame(camera_id, newer_than, client)
+        if frame is None:
+            return None
+        seconds = int(frame.timestamp)
+        image = [frame.width, frame.height, frame.channels, vd.kHSVColorSpace, seconds,
+                 int((frame.timestamp - seconds) * 1e6), frame.array.tostring(), camera_id]
+        with self.timer.stage("decode"):
+            return Frame.from_image(frame.frameID, camera_id, image)
+
+
+def run_detector(detector, log_path, update):
+    """
+    Run one detector over every frame of its camera in a frame log.
+
+    :arg:
+        :param detector: detector created with ip=None
+        :type detector: VisualBasis
+        :param log_path: path of the frame log
+        :type log_path: str
+        :param update: function running the detector on the next frame
+        :type update: function
+    :return:
+        the stage timer of the detector
+        :rtype: StageTimer
+    """
+    timer = StageTimer()
+    detector.stageTimer = timer
+    replay = DecodingReplay(log_path, timer)
+    replay.attach(detector)
+    stdout = sys.stdout
+    # The detectors print a lot on every frame, keep the report readable.
+    sys.stdout = open(os.devnull, "w")
+    try:
+        while True:
+            last_frame_id = detector.frameID
+            with timer.stage("total"):
+                update(detector)
+            if detector.frameID == last_frame_id:
+                timer.discard()
+                break
+            timer.lap()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        replay.close()
+    return timer
+
+
+def almath_landmark_positions(marks, camera_transform, landmark_size):
+    """
+    Reference of landmark_positions(), one almath transform chain per mark.
+
+    :return:
+        N * 2 array of [disX, disY]
+        :rtype: np.ndarray
+    """
+    import almath
+    robotToCamera = almath.Transform(almath.vectorFloat(list(camera_transform)))
+    positions = []
+    for wzCamera, wyCamera, angularSize in marks:
+        distCameraToLandmark = landmark_size / (2 * np.tan(angularSize / 2))
+        robotToLandmark = (robotToCamera * almath.Transform_from3DRotation(0, wyCamera, wzCamera) *
+                           almath.Transform(distCameraToLandmark, 0, 0))
+        positions.append([robotToLandmark.r1_c4, robotToLandmark.r2_c4])
+    return np.array(positions)
+
+
+def update_landmark(detector, almath_errors=None):
+    """
+    Load the next frame (and its pose) and run the landmark geometry of LandMarkDetect.update_landmark_data()
+    on a frame with all the marks of BENCH_MARKS.
+
+    :arg:
+        :param detector: the landmark detector
+        :type detector: LandMarkDetect
+        :param almath_errors: list receiving the largest distance to the almath results of each frame,
+                              None to skip the check
+        :type almath_errors: list
+    :return: None
+    """
+    detector.update_frame()
+    detector.landmark.marks = np.array(BENCH_MARKS)
+    with detector._stage("landmark_geometry"):
+        detector._update_landmark_position()
+    if almath_errors is not None:
+        reference = almath_landmark_positions(BENCH_MARKS, detector.camera_transform(),
+                                              detector.landmark.landmark_size)
+        almath_errors.append(float(np.hypot(*(detector.landmark.positions[:, :2] - reference).T).max()))
+
+
+def benchmark(log_path, engine="components", stand_state="standInit", with_landmark=True, stick_engine="contours",
+              almath_errors=None):
+    """
+    Time the stages of the ball, stick and landmark pipelines.
+
+    :arg:
+        :param log_path: path of the frame log
+        :type log_path: str
+        :param engine: circle detection engine of GolfBallDetect
+        :type engine: str
+        :param stand_state: Stand state of NAO robot, "standInit" or "standUp"
+        :type stand_state: str
+        :param with_landmark: whether to time the landmark geometry
+        :type with_landmark: bool
+        :param stick_engine: stick detection engine of StickDetect
+        :type stick_engine: str
+        :param almath_errors: list receiving the largest distance of the landmark positions to the almath
+                              results in each frame, None to skip the check (it needs almath)
+        :type almath_errors: list
+    :return:
+        stage name -> statistics, names prefixed with "ball.", "stick." and "landmark."
+        :rtype: collections.OrderedDict
+    """
+    stages = collections.OrderedDict()
+    timer = run_detector(GolfBallDetect(None, engine=engine), log_path,
+                         lambda detector: detector.update_ball_data(stand_state=stand_state))
+    stages.update(timer.summary("ball."))
+    timer = run_detector(StickDetect(None, engine=stick_engine), log_path,
+                         lambda detector: detector.update_stick_data())
+    stages.update(timer.summary("stick."))
+    if with_landmark:
+        timer = run_detector(LandMarkDetect(None), log_path,
+                             lambda detector: update_landmark(detector, almath_errors))
+        stages.update(timer.summary("landmark."))
+    return stages
+
+
+def find_regressions(stages, budgets, baseline=None, tolerance=0.25):
+    """
+    Find the stages slower than their budget, or slower than the baseline by more than the tolerance.
+
+    :arg:
+        :param stages: statistics returned by benchmark()
+        :type stages: dict
+        :param budgets: stage name -> largest mean time in milliseconds
+        :type budgets: dict
+        :param baseline: stages of an earlier run, None to skip the comparison
+        :type baseline: dict
+        :param tolerance: allowed slowdown against the baseline, 0.25 means 25%
+        :type tolerance: float
+    :return:
+        descriptions of the regressions
+        :rtype: list
+    """
+    regressions = []
+    for name, stats in stages.items():
+        if name in budgets and stats["mean_ms"] > budgets[name]:
+            regressions.append("%s: %.2f ms over the budget of %.2f ms" % (name, stats["mean_ms"], budgets[name]))
+        if baseline and name in baseline and stats["mean_ms"] > baseline[name]["mean_ms"] * (1 + tolerance):
+            regressions.append("%s: %.2f ms against %.2f ms in the baseline" %
+                               (name, stats["mean_ms"], baseline[name]["mean_ms"]))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time the vision pipeline stages on a frame log.")
+    parser.add_argument("log_path", help="frame log recorded with VisualBasis.start_recording()")
+    parser.add_argument("--engine", default="components", help="circle detection engine of GolfBallDetect")
+    parser.add_argument("--stick-engine", default="contours", choices=STICK_ENGINES,
+                        help="stick detection engine of StickDetect")
+    parser.add_argument("--stand-state", default="standInit", choices=["standInit", "standUp"])
+    parser.add_argument("--no-landmark", action="store_true", help="skip the landmark geometry")
+    parser.add_argument("--check-almath", action="store_true",
+                        help="check the landmark geometry against the almath transform chain (needs almath)")
+    parser.add_argument("--output", help="save the results to this JSON file")
+    parser.add_argument("--budget", help="JSON file of stage name -> largest mean time in ms")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown against the baseline")
+    args = parser.parse_args()
+
+    landmark_errors = [] if args.check_almath else None
+    results = benchmark(args.log_path, args.engine, args.stand_state, not args.no_landmark, args.stick_engine,
+                        landmark_errors)
+    print "%-28s %8s %10s %10s %10s" % ("stage", "frames", "mean ms", "p95 ms", "max ms")
+    for stage_name, stage_stats in results.items():
+        print "%-28s %8d %10.3f %10.3f %10.3f" % (stage_name, stage_stats["frames"], stage_stats["mean_ms"],
+                                                  stage_stats["p95_ms"], stage_stats["max_ms"])
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump({"log": args.log_path, "engine": args.engine, "stick_engine": args.stick_engine,
+                       "stages": results}, output_file, indent=2)
+
+    stage_budgets = {}
+    if args.budget:
+        with open(args.budget) as budget_file:
+            stage_budgets = json.load(budget_file)
+    baseline_stages = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline_stages = json.load(baseline_file)["stages"]
+    found = find_regressions(results, stage_budgets, baseline_stages, args.tolerance)
+    if landmark_errors:
+        print "landmark geometry: %.3g m at most from almath" % max(landmark_errors)
+        if max(landmark_errors) > ALMATH_TOLERANCE:
+            found.append("landmark geometry: %.3g m away from almath" % max(landmark_errors))
+    for regression in found:
+        print "REGRESSION " + regression
+    sys.exit(1 if found else 0)
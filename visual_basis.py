@@ -8,11 +8,33 @@
 """
 
 import cv2
-import time
 import numpy as np
 import vision_definitions as vd
 
+from naoqi import ALProxy
 from nao_configure import NAOConfigure
+from frame_bus import Frame
+from frame_log import FrameRecorder
+from frame_grabber import FrameGrabber, grab_image
+from stage_timer import NULL_STAGE
+from preprocess_pipeline import PreprocessPipeline
+from ground_projection import horizon_row
+
+
+def _read_only_view(array):
+    """
+    Get a read-only view sharing the memory of the given array.
+
+    :arg:
+        :param array: the array to view
+        :type array: np.ndarray
+    :return:
+        read-only view of the array
+        :rtype: np.ndarray
+    """
+    view = array.view()
+    view.flags.writeable = False
+    return view
 
 
 class VisualBasis(NAOConfigure):
@@ -44,42 +66,304 @@ class VisualBasis(NAOConfigure):
         self.frameWidth = 0
         self.frameChannels = 0
         self._frameArray = np.array([])
+        self.frameID = 0
+        self.frameTimestamp = 0.0
+        self._frame = None
         self._gray_frame = np.array([])
         self.cameraPitchRange = 47.64 / 180 * np.pi  # 俯仰角范围
         self.cameraYawRange = 60.97 / 180 * np.pi  # 偏航角范围
-        self.cameraProxy.setActiveCamera(self.cameraID)
+        self._grabber = None
+        self._frameCount = 0
+        self._frameSource = None
+        self._recorder = None
+        self.poseSnapshot = None
+        self.stageTimer = None
+        self.pipeline = PreprocessPipeline()
+        self.cameraName = "CameraTop" if camera_id == vd.kTopCamera else "CameraBottom"
+        if self.cameraProxy is not None:
+            self.cameraProxy.setActiveCamera(self.cameraID)
+
+    def attach_frame_source(self, source):
+        """
+        Read frames from a shared frame source (such as a FrameBus) instead of grabbing them.
 
-    def update_frame(self, client="python-client"):
+        :arg:
+            :param source: object providing get_frame(camera_id, newer_than, client), None to detach
+            :type source: FrameBus
+        :return: None
+        """
+        self._frameSource = source
+        self.frameID = 0
+
+    def _stage(self, name):
+        """
+        Time a stage of the pipeline with the attached StageTimer.
+
+        :arg:
+            :param name: name of the stage
+            :type name: str
+        :return:
+            context timing the stage, doing nothing without a timer
+            :rtype: object
+        """
+        if self.stageTimer is None:
+            return NULL_STAGE
+        return self.stageTimer.stage(name)
+
+    def attach_pose_snapshot(self, snapshot):
+        """
+        Read the head angles and camera poses from a shared snapshot instead of asking ALMotion.
+
+        :arg:
+            :param snapshot: the shared snapshot, None to detach
+            :type snapshot: PoseSnapshot
+        :return: None
+        """
+        self.poseSnapshot = snapshot
+
+    def camera_position(self, name=None):
+        """
+        Get the 6D position of a camera (or the head) in FRAME_ROBOT.
+
+        :arg:
+            :param name: "CameraTop", "CameraBottom" or "Head", None for the camera of this detector
+            :type name: str
+        :return:
+            [x, y, z, wx, wy, wz]
+            :rtype: list
+        """
+        name = name or self.cameraName
+        if self.poseSnapshot is not None:
+            return self.poseSnapshot.get_position(name, self.frameTimestamp)
+        # 2 means FRAME_ROBOT,
+        # True means the sensor values will be used to determine the position.
+        return self.motionProxy.getPosition(name, 2, True)
+
+    def head_angles(self):
+        """
+        Get the head angles.
+
+        :return:
+            [HeadYaw, HeadPitch] in rad
+            :rtype: list
+        """
+        if self.poseSnapshot is not None:
+            return self.poseSnapshot.get_head_angles(self.frameTimestamp)
+        return self.motionProxy.getAngles(["HeadYaw", "HeadPitch"], True)
+
+    def ground_top_row(self, object_height=0.0, margin=0, camera_position=None):
+        """
+        First row of the frame where an object standing on the ground can appear, the horizon from the pitch
+        and the height of the camera in the pose data.
+
+        :arg:
+            :param object_height: height of the object in meter, the whole frame is kept for objects higher than
+                                  the camera
+            :type object_height: float
+            :param margin: rows kept above the horizon, for the size of the object and the errors of the pose
+            :type margin: int
+            :param camera_position: 6D position of the camera of this detector if already known, None to read it
+            :type camera_position: list
+        :return:
+            the row in [0, frameHeight], frameHeight when the camera looks over the ground
+            :rtype: int
+        """
+        if camera_position is None:
+            camera_position = self.camera_position()
+        if object_height >= camera_position[2]:
+            return 0
+        row = horizon_row((self.frameWidth, self.frameHeight), (self.cameraYawRange, self.cameraPitchRange),
+                          camera_position) - margin
+        return int(min(max(row, 0), self.frameHeight))
+
+    def camera_transform(self, name=None):
+        """
+        Get the transform of a camera (or the head) in FRAME_ROBOT.
+
+        :arg:
+            :param name: "CameraTop", "CameraBottom" or "Head", None for the camera of this detector
+            :type name: str
+        :return:
+            the 16 values of the transform, row major
+            :rtype: list
+        """
+        name = name or self.cameraName
+        if self.poseSnapshot is not None:
+            return self.poseSnapshot.get_transform(name, self.frameTimestamp)
+        return self.motionProxy.getTransform(name, 2, True)  # 2 means FRAME_ROBOT
+
+    def start_streaming(self, client="python-client", buffer_size=3):
+        """
+        Subscribe the camera once and keep grabbing frames in a background thread,
+        update_frame() will then only read the latest buffered frame.
+
+        :arg:
+            :param client: client name
+            :type client: str
+            :param buffer_size: how many of the latest frames are kept
+            :type buffer_size: int
+        :return: None
+        """
+        if self._grabber is not None:
+            return
+        # The grabber thread gets its own proxy so that it never shares a connection with the main thread.
+        camera_proxy = ALProxy("ALVideoDevice", self.ip, self.port)
+        self._grabber = FrameGrabber(camera_proxy, client, self.cameraID, self.resolution,
+                                     self.colorSpace, self.fps, buffer_size)
+        self._grabber.start()
+        self._frameCount = 0
+
+    def stop_streaming(self):
+        """
+        Stop the background grabber and release its camera subscription.
+
+        :return: None
+        """
+        if self._grabber is not None:
+            self._grabber.stop()
+            self._grabber = None
+
+    @property
+    def is_streaming(self):
+        """
+        Whether frames are grabbed by a background streaming subscription.
+
+        :return:
+            True means streaming else not.
+            :rtype: bool
+        """
+        return self._grabber is not None
+
+    def update_frame(self, client="python-client", timeout=1.0):
         """
         Get a new image from the specific camera and save it in self._frame.
 
         :arg:
             :param client: client name
             :type client: str
+            :param timeout: maximum seconds to wait for a new frame while streaming
+            :type timeout: float
         :return: None
         :raise: IndexError
         """
-        if self.cameraProxy.getActiveCamera() != self.cameraID:
-            self.cameraProxy.setActiveCamera(self.cameraID)
-            time.sleep(1)
-
-        video_client = self.cameraProxy.subscribeCamera(client, self.cameraID,
-                                                        self.resolution, self.colorSpace, self.fps)
-        frame = self.cameraProxy.getImageRemote(video_client)
-        self.cameraProxy.unsubscribe(video_client)
-        try:
-            self.frameWidth = frame[0]
-            self.frameHeight = frame[1]
-            self.frameChannels = frame[2]
-            self._frameArray = np.frombuffer(frame[6], dtype=np.uint8).reshape([frame[1], frame[0], frame[2]])
-            print "update done"
-        except IndexError:
+        if self._frameSource is not None:
+            self._load_frame(self._frameSource.get_frame(self.cameraID, self.frameID, client))
+            return
+
+        if self._grabber is not None:
+            self._frameCount, image = self._grabber.latest(self._frameCount, timeout)
+            self._load_image(image)
+            return
+
+        # subscribeCamera() picks the camera by itself, switching the active camera is not needed.
+        image = grab_image(self.cameraProxy, client, self.cameraID, self.resolution, self.colorSpace, self.fps)
+        self._load_image(image)
+
+    def _load_image(self, image):
+        """
+        Parse a naoqi image container and save it as the current frame.
+
+        :arg:
+            :param image: image container returned by getImageRemote
+            :type image: list
+        :return: None
+        """
+        with self._stage("decode"):
+            frame = Frame.from_image(self.frameID + 1, self.cameraID, image)
+        self._load_frame(frame)
+
+    def _load_frame(self, frame):
+        """
+        Save the given frame as the current frame, the image data is shared rather than copied.
+
+        :arg:
+            :param frame: the frame to load, None means getting image failed
+            :type frame: Frame
+        :return: None
+        """
+        if frame is None:
             print "get image failed!"
+            return
+        self._frame = frame
+        self.frameID = frame.frameID
+        self.frameTimestamp = frame.timestamp
+        self.frameWidth = frame.width
+        self.frameHeight = frame.height
+        self.frameChannels = frame.channels
+        self._frameArray = frame.array
+        print "update done"
+        if self._recorder is not None:
+            self._record_frame(frame)
+
+    def start_recording(self, log_path):
+        """
+        Append every new frame, together with the head angles and the camera pose, to a frame log.
+
+        :arg:
+            :param log_path: path of the log file
+            :type log_path: str
+        :return: None
+        """
+        self.stop_recording()
+        self._recorder = FrameRecorder(log_path)
+
+    def stop_recording(self):
+        """
+        Stop recording and close the frame log.
+
+        :return: None
+        """
+        if self._recorder is not None:
+            self._recorder.close()
+            self._recorder = None
+
+    def _record_frame(self, frame):
+        """
+        Append the given frame and the current pose to the frame log.
+
+        :arg:
+            :param frame: the frame to record
+            :type frame: Frame
+        :return: None
+        """
+        self._recorder.append(frame, self.head_angles(), self.camera_position())
+
+    def frame_labels(self, table, top=0, bottom=None, left=0, right=None):
+        """
+        Get color labels of the current frame or a part of it. Labels of the whole frame are computed once
+        per frame and kept with it, so every detector reading the same frame shares one classification pass.
+
+        :arg:
+            :param table: color table to classify the pixels with
+            :type table: ColorTable
+            :param top: first row of the part
+            :type top: int
+            :param bottom: row after the last row of the part, None for the bottom of the frame
+            :type bottom: int
+            :param left: first column of the part
+            :type left: int
+            :param right: column after the last column of the part, None for the right of the frame
+            :type right: int
+        :return:
+            read-only label image
+            :rtype: np.ndarray
+        """
+        is_whole = top == 0 and left == 0 and bottom is None and right is None
+        labels = self._frame.cache.get(table.key) if self._frame is not None else None
+        if labels is None:
+            if not is_whole:
+                with self._stage("classify"):
+                    return _read_only_view(self.pipeline.classify(table, self._frameArray[top:bottom, left:right]))
+            with self._stage("classify"):
+                labels = table.classify(self._frameArray)
+            if self._frame is not None:
+                self._frame.cache[table.key] = labels
+        return _read_only_view(labels[top:bottom, left:right])
 
     @property
     def frame_array(self):
         """
-        Get current frame array.
+        Get a writable copy of current frame array, use it only when the frame is going to be modified.
 
         :return:
             current frame array (empty array if None)
@@ -87,10 +371,21 @@ class VisualBasis(NAOConfigure):
         """
         return self._frameArray.copy()
 
+    @property
+    def frame_view(self):
+        """
+        Get a read-only view of current frame array without copying it.
+
+        :return:
+            current frame array (empty array if None)
+            :rtype: np.ndarray
+        """
+        return _read_only_view(self._frameArray)
+
     @property
     def gray_frame(self):
         """
-        Get preprocessed binary image.
+        Get a writable copy of preprocessed binary image, use it only when the image is going to be modified.
 
         :return:
             Preprocessed image
@@ -98,6 +393,17 @@ class VisualBasis(NAOConfigure):
         """
         return self._gray_frame.copy()
 
+    @property
+    def gray_view(self):
+        """
+        Get a read-only view of preprocessed binary image without copying it.
+
+        :return:
+            Preprocessed image
+            :rtype: np.ndarray
+        """
+        return _read_only_view(self._gray_frame)
+
     def show_frame(self):
         """
         Show current frame data.
@@ -107,7 +413,7 @@ class VisualBasis(NAOConfigure):
         if self._frameArray.size == 0:
             print "Please get an image from NAO with method update_frame() first"
         else:
-            cv2.imshow("Current Frame", cv2.cvtColor(self.frame_array, cv2.COLOR_HSV2BGR_FULL))
+            cv2.imshow("Current Frame", cv2.cvtColor(self.frame_view, cv2.COLOR_HSV2BGR_FULL))
             cv2.waitKey(10)
 
     def show_gray_frame(self):
@@ -119,7 +425,7 @@ class VisualBasis(NAOConfigure):
         if self._gray_frame.size == 0:
             print "Please get an image from NAO with method update_frame() first"
         else:
-            cv2.imshow("Current bin Frame", self.gray_frame)
+            cv2.imshow("Current bin Frame", self.gray_view)
 
     def print_frame_data(self):
         """